@@ -0,0 +1,195 @@
+import numpy as np
+
+PRECISIONS = ("float64", "float32", "int32")
+# Rows encoded or multiplied at once when a whole matrix is traversed
+BLOCK_ROWS = 1024
+
+def euclidean_distances(locations, rows, cols):
+    """
+    Distances between locations[rows] and locations[cols], rows and cols are broadcast together
+    """
+    dx = locations[rows, 0] - locations[cols, 0]
+    dy = locations[rows, 1] - locations[cols, 1]
+    return np.sqrt(dx*dx + dy*dy)
+
+class DistanceMatrix:
+    """
+    Symmetric distance matrix with a selectable storage
+    precision: "float64", "float32" or "int32" (distances multiplied by scale and rounded)
+    condensed: only the upper triangle is stored
+    lazy: only the locations are stored and distances are computed when they are read
+    Indexing works like a 2D array and only computes the requested block. np.asarray returns
+    the stored matrix without a copy only when it is dense and in floating point, otherwise it
+    builds the full dense matrix, so KMedoids, the cost kernel, the worker pools and OR-Tools
+    index it instead. The QUBO builders and the exact TSP solvers take dense copies of their
+    (cluster sized) matrices
+    """
+    def __init__(self, locations=None, distances=None, precision="float64", condensed=False, lazy=False, scale=1000):
+        if (locations is None) == (distances is None):
+            raise ValueError("DistanceMatrix needs either locations or distances")
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision {}".format(precision))
+        if lazy and locations is None:
+            raise ValueError("A lazy DistanceMatrix needs the locations")
+        self.precision = precision
+        self.condensed = condensed and not lazy
+        self.lazy = lazy
+        self.scale = scale
+        self.locations = None if locations is None else np.asarray(locations, dtype=float)
+        self.n = len(self.locations) if distances is None else len(distances)
+        self.values = None
+        if lazy:
+            return
+        if self.condensed:
+            self.values = np.empty(self.n*(self.n-1)//2, dtype=self.storage_dtype())
+            start = 0
+            for i in range(self.n-1):
+                cols = np.arange(i+1, self.n)
+                if distances is None:
+                    row = euclidean_distances(self.locations, i, cols)
+                else:
+                    row = np.asarray(distances[i])[i+1:]
+                self.values[start:start+len(cols)] = self.encode(row)
+                start += len(cols)
+        elif distances is None:
+            self.values = self.encode(euclidean_distances(self.locations, np.arange(self.n)[:, None], np.arange(self.n)[None, :]))
+        else:
+            # Encoded in blocks of rows, so a full float64 temporary is never built
+            self.values = np.empty((self.n, self.n), dtype=self.storage_dtype())
+            for start in range(0, self.n, BLOCK_ROWS):
+                self.values[start:start+BLOCK_ROWS] = self.encode(np.asarray(distances[start:start+BLOCK_ROWS]))
+
+    @classmethod
+    def from_locations(cls, locations, precision="float64", condensed=False, lazy=False, scale=1000):
+        return cls(locations=locations, precision=precision, condensed=condensed, lazy=lazy, scale=scale)
+
+    @classmethod
+    def from_matrix(cls, distances, precision="float64", condensed=False, scale=1000):
+        """
+        condensed=True assumes distances is symmetric with a zero diagonal
+        """
+        return cls(distances=distances, precision=precision, condensed=condensed, scale=scale)
+
+    def share_parts(self):
+        """
+        Returns the array holding the distances (the locations when lazy) and the settings
+        needed to rebuild the matrix over a copy of that array, e.g. in shared memory
+        """
+        settings = {"precision": self.precision, "condensed": self.condensed, "lazy": self.lazy,
+                    "scale": self.scale, "n": self.n}
+        return (self.locations if self.lazy else self.values), settings
+
+    @classmethod
+    def from_parts(cls, array, settings):
+        """
+        Rebuilds a matrix from share_parts without copying array
+        """
+        matrix = cls.__new__(cls)
+        matrix.__dict__.update(settings)
+        matrix.locations = array if settings["lazy"] else None
+        matrix.values = None if settings["lazy"] else array
+        return matrix
+
+    def storage_dtype(self):
+        return np.dtype(self.precision)
+
+    def encode(self, values):
+        if self.precision == "int32":
+            return np.rint(values*self.scale).astype(np.int32)
+        return np.asarray(values, dtype=self.storage_dtype())
+
+    def decode(self, values):
+        if self.precision == "int32":
+            return values/self.scale
+        return values
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64) if self.precision == "int32" else self.storage_dtype()
+
+    @property
+    def nbytes(self):
+        """
+        Bytes used by the stored distances (or locations when lazy)
+        """
+        return self.locations.nbytes if self.lazy else self.values.nbytes
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+    def get(self, rows, cols):
+        """
+        Distances between rows and cols, broadcast together like numpy index arrays
+        """
+        rows, cols = np.broadcast_arrays(np.asarray(rows), np.asarray(cols))
+        if self.lazy:
+            return self.decode(self.encode(euclidean_distances(self.locations, rows, cols)))
+        if not self.condensed:
+            return self.decode(self.values[rows, cols])
+        diagonal = rows == cols
+        values = self.decode(self.values[np.where(diagonal, 0, self.condensed_index(rows, cols))])
+        return np.where(diagonal, 0, values)
+
+    def condensed_index(self, rows, cols):
+        """
+        Position of (rows, cols) in the condensed upper triangle, rows != cols
+        """
+        low = np.minimum(rows, cols)
+        high = np.maximum(rows, cols)
+        return low*self.n - low*(low+1)//2 + high - low - 1
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError("DistanceMatrix takes two indices")
+        if not self.lazy and not self.condensed:
+            return self.decode(self.values[key])
+        positions = np.arange(self.n)
+        rows, cols = positions[key[0]], positions[key[1]]
+        # Slices select the full block, like in numpy
+        if isinstance(key[0], slice) or isinstance(key[1], slice):
+            rows, cols = np.reshape(rows, np.shape(rows) + (1,)*np.ndim(cols)), cols
+        values = self.get(rows, cols)
+        return values[()] if values.ndim == 0 else values
+
+    def submatrix(self, indices):
+        """
+        Returns the DistanceMatrix of the nodes in indices with the same storage,
+        dense matrices indexed with a slice share the stored values
+        """
+        if self.lazy:
+            return DistanceMatrix.from_locations(self.locations[indices], self.precision, lazy=True, scale=self.scale)
+        subset = DistanceMatrix.__new__(DistanceMatrix)
+        subset.__dict__.update(self.__dict__)
+        if self.locations is not None:
+            subset.locations = self.locations[indices]
+        if self.condensed:
+            positions = np.arange(self.n)[indices]
+            rows, cols = np.triu_indices(len(positions), 1)
+            subset.values = self.values[self.condensed_index(positions[rows], positions[cols])]
+            subset.n = len(positions)
+        elif isinstance(indices, slice):
+            subset.values = self.values[indices, indices]
+            subset.n = len(subset.values)
+        else:
+            subset.values = self.values[np.ix_(indices, indices)]
+            subset.n = len(subset.values)
+        return subset
+
+    def __array__(self, dtype=None, copy=None):
+        if not self.lazy and not self.condensed and self.precision != "int32":
+            values = self.values
+        else:
+            values = self[:, :]
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+        return values
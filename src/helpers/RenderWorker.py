@@ -0,0 +1,47 @@
+import multiprocessing as mp
+import traceback
+
+import matplotlib.pyplot as plt
+
+# Figures waiting to be drawn, a full queue makes submit wait instead of growing without bound
+MAX_QUEUED_FIGURES = 32
+
+class RenderWorker:
+    """
+    Background process that draws and saves figures with the headless Agg backend, so the solve
+    loops only pay for queueing the data of a figure
+    submit(plot_function, *args) queues a call, the function must save its figure (save_file)
+    close() waits until every queued figure is saved
+    """
+    def __init__(self, max_queued=MAX_QUEUED_FIGURES):
+        self.queue = mp.Queue(max_queued)
+        self.process = mp.Process(target=render_loop, args=(self.queue,), daemon=True)
+        self.process.start()
+
+    def submit(self, plot_function, *args, **kwargs):
+        self.queue.put((plot_function, args, kwargs))
+
+    def close(self):
+        self.queue.put(None)
+        self.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def render_loop(queue):
+    plt.switch_backend("Agg")
+    while True:
+        task = queue.get()
+        if task is None:
+            break
+        plot_function, args, kwargs = task
+        try:
+            plot_function(*args, **kwargs)
+        except Exception:
+            # A figure that fails is reported and the next ones are still drawn
+            traceback.print_exc()
+            plt.close("all")
@@ -0,0 +1,55 @@
+import numpy as np
+
+from helpers.check_solution import check_solutions
+
+class RouteTotals:
+    """
+    Distance, energy and errors of a solution whose routes arrive one at a time and in any order
+    Every route is scored when it arrives, only the customer visits need all of them and are
+    counted when errors() is called, so the totals match calculate_total_distance and check_solution
+    """
+    def __init__(self, distances, customer_demand, vehicle_capacity, starting_depot=0, ending_depot=0, check_capacity=True):
+        self.distances = distances
+        self.customer_demand = customer_demand
+        self.vehicle_capacity = vehicle_capacity
+        self.starting_depot = starting_depot
+        self.ending_depot = ending_depot
+        self.check_capacity = check_capacity
+        self.num_customers = len(customer_demand)
+        self.routes = [None]*len(vehicle_capacity)
+        self.visits = np.zeros(self.num_customers, dtype=int)
+        self.total_distance = 0
+        self.total_energy = 0
+        self.route_errors = 0
+
+    def route_errors_of(self, k, route):
+        errors = check_solutions([[route]], self.starting_depot, self.ending_depot, self.customer_demand,
+                                 [self.vehicle_capacity[k]], self.check_capacity)
+        del errors["visits"]
+        return int(sum(e[0] for e in errors.values()))
+
+    def add(self, k, route, energy=0):
+        """
+        Adds the route of vehicle k and the energy of the read it comes from
+        """
+        self.routes[k] = route
+        for i, j in route:
+            self.total_distance += self.distances[i, j]
+        self.total_energy += energy
+        arcs = np.array(route, dtype=int).reshape(-1, 2)
+        customers = arcs[:, 1][(arcs[:, 1] >= 1) & (arcs[:, 1] <= self.num_customers)]
+        self.visits += np.bincount(customers-1, minlength=self.num_customers)
+        self.route_errors += self.route_errors_of(k, route)
+
+    def solution(self):
+        """
+        Routes in vehicle order, vehicles without a route yet have an empty one
+        """
+        return [route if route is not None else [] for route in self.routes]
+
+    def errors(self):
+        """
+        Number of broken constraints of the routes added so far, like check_solution
+        """
+        missing = sum(self.route_errors_of(k, []) for k, route in enumerate(self.routes) if route is None)
+        return self.route_errors + missing + int((self.visits != 1).sum())
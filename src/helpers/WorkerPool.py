@@ -0,0 +1,132 @@
+import importlib
+import queue
+import multiprocessing as mp
+from collections import namedtuple, OrderedDict
+
+from helpers.shared_arrays import create_shared_array, attach_shared_array, release_shared_arrays
+from helpers.DistanceMatrix import DistanceMatrix
+
+# Modules every worker imports when it starts, so the first task of each worker does not pay for them
+PRELOAD_MODULES = ["numpy", "ortools.constraint_solver.pywrapcp", "neal", "dimod", "pyqubo"]
+# Instances a worker keeps attached, the least recently used one is closed first
+MAX_ATTACHED_INSTANCES = 4
+
+# matrices has the settings of the arrays that are a DistanceMatrix, rebuilt over the shared array
+InstanceHandle = namedtuple("InstanceHandle", ["instance_id", "specs", "matrices"], defaults=({},))
+
+class WorkerPool:
+    """
+    Long lived process pool owned by a pipeline and reused by all its stages and problems
+    The arrays of an instance are copied once into shared memory with share_instance and the
+    tasks read them with load_instance(handle), only the small handle is pickled with every task
+    """
+    def __init__(self, processes=None, preload=PRELOAD_MODULES):
+        self.processes = processes or mp.cpu_count()
+        self.pool = mp.Pool(self.processes, initializer=init_pool_worker, initargs=(preload,))
+        self.instances = {}
+
+    def share_instance(self, instance_id, **arrays):
+        """
+        Publishes the arrays of an instance (e.g. distances=...) in shared memory,
+        an id that is already shared returns its handle, so an id must always name the same arrays
+        A DistanceMatrix shares its stored array, so it keeps its compact storage in the workers
+        Returns the handle to pass to the tasks
+        """
+        if instance_id in self.instances:
+            return self.instances[instance_id][0]
+        blocks = []
+        specs = {}
+        matrices = {}
+        for key, array in arrays.items():
+            if isinstance(array, DistanceMatrix):
+                array, matrices[key] = array.share_parts()
+            block, shared, specs[key] = create_shared_array(array)
+            blocks += [block]
+        handle = InstanceHandle(instance_id, specs, matrices)
+        self.instances[instance_id] = (handle, blocks)
+        return handle
+
+    def release_instance(self, instance_id):
+        """
+        Frees the shared memory of an instance once its tasks are done
+        """
+        handle, blocks = self.instances.pop(instance_id)
+        release_shared_arrays(blocks)
+
+    def apply_async(self, func, args=(), kwds={}):
+        return self.pool.apply_async(func, args, kwds)
+
+    def as_completed(self, func, tasks, sizes=None):
+        """
+        Runs func(*args) for every args in tasks and yields (index, result) as each task finishes
+        Tasks are submitted by decreasing size, so the longest ones do not start last
+        """
+        order = sorted(range(len(tasks)), key=lambda i: -sizes[i]) if sizes is not None else range(len(tasks))
+        done = queue.Queue()
+        for i in order:
+            # Callbacks run in the thread of the pool that collects the results
+            self.pool.apply_async(func, tasks[i],
+                                  callback=lambda result, i=i: done.put((i, result, None)),
+                                  error_callback=lambda error, i=i: done.put((i, None, error)))
+        for _ in range(len(tasks)):
+            i, result, error = done.get()
+            if error is not None:
+                raise error
+            yield i, result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for instance_id in list(self.instances):
+            self.release_instance(instance_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+attached_instances = OrderedDict()
+
+def init_pool_worker(preload):
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            # Tasks that need a missing module fail on their own
+            pass
+
+def instance_key(handle):
+    """
+    Key of the shared arrays behind a handle, to cache per process what is built from them
+    Block names are unique, so an id shared again after its release gets a new key
+    """
+    return tuple(spec[0] for spec in handle.specs.values())
+
+def load_instance(handle):
+    """
+    Returns the shared arrays of an instance as a dictionary, attached once per process
+    """
+    key = instance_key(handle)
+    if key in attached_instances:
+        attached_instances.move_to_end(key)
+        return attached_instances[key][1]
+    blocks = []
+    arrays = {}
+    for name, spec in handle.specs.items():
+        block, arrays[name] = attach_shared_array(spec)
+        blocks += [block]
+        if name in handle.matrices:
+            arrays[name] = DistanceMatrix.from_parts(arrays[name], handle.matrices[name])
+    attached_instances[key] = (blocks, arrays)
+    while len(attached_instances) > MAX_ATTACHED_INSTANCES:
+        old_blocks, old_arrays = attached_instances.popitem(last=False)[1]
+        old_arrays.clear()
+        for block in old_blocks:
+            try:
+                block.close()
+            except BufferError:
+                # A task still holds a view, the block is closed when the process exits
+                pass
+    return arrays
@@ -0,0 +1,121 @@
+import itertools
+import json
+import os
+import time
+import traceback
+from os.path import dirname, getsize, join
+
+BENCHMARKS_DIR = join(dirname(dirname(os.path.abspath(__file__))), 'benchmarks')
+INSTANCE_GROUPS_FILE = join(BENCHMARKS_DIR, 'instances.json')
+
+def load_instance_groups(path=INSTANCE_GROUPS_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+def get_instances(names, path=INSTANCE_GROUPS_FILE):
+    """
+    Expands a list of instance group names (CMT, M, Golden, Li, X) and file names into file names
+    """
+    groups = load_instance_groups(path)
+    instances = []
+    for name in names:
+        instances += groups[name] if name in groups else [name]
+    return instances
+
+def load_manifest(path):
+    """
+    Reads a manifest and returns its settings and its jobs, one per instance, algorithm and
+    combination of parameters. Every entry of "jobs" has "instances" (groups or file names),
+    "algorithm" and optionally "params", whose lists are swept:
+    {"data_dir": "./data/", "checkpoint": "./results/benchmarks/checkpoint.jsonl",
+     "jobs": [{"instances": ["CMT"], "algorithm": "qubo_clustering", "params": {"num_reads": [1000, 5000]}}]}
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    jobs = []
+    for entry in manifest["jobs"]:
+        params = entry.get("params", {})
+        names = list(params)
+        values = [value if isinstance(value, list) else [value] for value in params.values()]
+        for instance in get_instances(entry["instances"]):
+            for combination in itertools.product(*values):
+                jobs += [{"instance": instance, "algorithm": entry["algorithm"],
+                          "params": dict(zip(names, combination))}]
+    return manifest, jobs
+
+def job_key(job):
+    return json.dumps([job["instance"], job["algorithm"], job["params"]], sort_keys=True)
+
+def read_checkpoint(path):
+    """
+    Returns the finished records of a checkpoint by job key, failed jobs are left out so they run again
+    A line cut by an interrupted write is skipped
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in record:
+                records[job_key(record)] = record
+    return records
+
+def append_checkpoint(f, record):
+    """
+    Writes one record and syncs it to disk, so an interruption never loses a finished job
+    """
+    # numpy values are written as python numbers and lists
+    f.write(json.dumps(record, sort_keys=True, default=lambda value: value.tolist())+"\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def predicted_cost(job, data_dir, cost_exponents):
+    """
+    Relative cost of a job, used to start the longest jobs first
+    The size of the instance file grows linearly with its nodes, and the cost of each algorithm
+    with a power of them (cost_exponents), times the number of reads when it has them
+    A missing file costs nothing, its job fails in run_job and the error is recorded
+    """
+    exponent = cost_exponents.get(job["algorithm"], 2)
+    try:
+        size = getsize(join(data_dir, job["instance"]))
+    except OSError:
+        size = 0
+    return size**exponent * job["params"].get("num_reads", 1)
+
+def run_job(func, data_dir, job):
+    """
+    Runs one job in a worker, errors are returned in the record instead of stopping the batch
+    """
+    record = dict(job)
+    start = time.time()
+    try:
+        record["result"] = func(join(data_dir, job["instance"]), **job["params"])
+    except Exception:
+        record["error"] = traceback.format_exc()
+    record["time"] = time.time()-start
+    return record
+
+def run_batch(jobs, algorithms, pool, checkpoint, data_dir, cost_exponents={}):
+    """
+    Runs the jobs of a manifest that are not in the checkpoint yet, longest first, and appends
+    every record to the checkpoint as soon as its job finishes
+    algorithms maps the algorithm names to functions taking the path of the instance and the params
+    Yields the records in completion order
+    """
+    unknown = {job["algorithm"] for job in jobs} - set(algorithms)
+    if unknown:
+        raise ValueError("Unknown algorithms {}".format(sorted(unknown)))
+    done = read_checkpoint(checkpoint)
+    pending = [job for job in {job_key(job): job for job in jobs}.values() if job_key(job) not in done]
+    tasks = [(algorithms[job["algorithm"]], data_dir, job) for job in pending]
+    costs = [predicted_cost(job, data_dir, cost_exponents) for job in pending]
+    os.makedirs(dirname(os.path.abspath(checkpoint)), exist_ok=True)
+    with open(checkpoint, 'a') as f:
+        for i, record in pool.as_completed(run_job, tasks, sizes=costs):
+            append_checkpoint(f, record)
+            yield record
@@ -1,3 +1,5 @@
+import numpy as np
+
 def check_constraint1(solution, num_customers, num_vehicles, verbose):
     if verbose:
         print('\nChecking first constraint:')
@@ -183,6 +185,13 @@ def check_capacity_errors(solution, customer_demand, vehicle_capacity, depot, ve
             
 def check_solution(solution, starting_depot, ending_depot, 
                    customer_demand, vehicle_capacity, check_capacity=True, verbose=True):
+    """
+    Returns the number of broken constraints, verbose prints every check
+    """
+    if not verbose:
+        errors = check_solutions([solution], starting_depot, ending_depot,
+                                 customer_demand, vehicle_capacity, check_capacity)
+        return int(sum(e[0] for e in errors.values()))
     num_customers = len(customer_demand)
     num_vehicles = len(vehicle_capacity)
     errors = 0
@@ -195,4 +204,109 @@ def check_solution(solution, starting_depot, ending_depot,
     if check_capacity:
         errors += check_capacity_errors(solution, customer_demand, vehicle_capacity, ending_depot, verbose)
     return errors
-    
\ No newline at end of file
+    
+CONSTRAINTS = ["visits", "starts", "dead_ends", "impossible_starts", "ends", "subtours", "capacity"]
+
+def solutions_to_arcs(solutions, num_vehicles):
+    """
+    Flattens solutions (a list of routes of (i, j) arcs each) into the solution, vehicle, i and j
+    arrays of all their arcs, routes past num_vehicles are left out
+    """
+    sol, veh, arcs = [], [], []
+    for s, solution in enumerate(solutions):
+        for k, route in enumerate(solution[:num_vehicles]):
+            sol += [s]*len(route)
+            veh += [k]*len(route)
+            arcs += list(route)
+    arcs = np.array(arcs, dtype=int).reshape(-1, 2)
+    return np.array(sol, dtype=int), np.array(veh, dtype=int), arcs[:, 0], arcs[:, 1]
+
+def count_by(keys, queries):
+    """
+    Number of times each query appears in keys
+    """
+    unique, counts = np.unique(keys, return_counts=True)
+    if len(unique) == 0:
+        return np.zeros(len(queries), dtype=int)
+    position = np.minimum(np.searchsorted(unique, queries), len(unique)-1)
+    return np.where(unique[position] == queries, counts[position], 0)
+
+def count_subtour_errors(group, i, j, num_groups, num_nodes):
+    """
+    A vehicle fails when following the successors (the last arc leaving a node wins) from the
+    source of its first arc does not visit every source once before returning, or reaches a node
+    that is never left, or when it has no arcs. All the vehicles are walked at the same time
+    Returns a boolean array with the failing groups
+    """
+    # Successor of every source, reversed so np.unique keeps the last arc
+    keys = group*num_nodes + i
+    sources, last = np.unique(keys[::-1], return_index=True)
+    successors = j[::-1][last]
+    num_sources = np.bincount(sources // num_nodes, minlength=num_groups)
+    groups_with_arcs, first_arc = np.unique(group, return_index=True)
+    
+    failed = num_sources == 0
+    current = np.full(num_groups, -1)
+    current[groups_with_arcs] = np.searchsorted(sources, keys[first_arc])
+    visited = np.zeros(len(sources), dtype=bool)
+    for step in range(num_sources.max(initial=0)):
+        walking = np.flatnonzero(~failed & (step < num_sources))
+        position = current[walking]
+        # Coming back before every source is visited leaves a second route
+        failed[walking[visited[position]]] = True
+        visited[position] = True
+        queries = walking*num_nodes + successors[position]
+        following = np.minimum(np.searchsorted(sources, queries), len(sources)-1)
+        # The successor is never left (dead end)
+        failed[walking[sources[following] != queries]] = True
+        current[walking] = following
+    return failed
+
+def check_solutions(solutions, starting_depot, ending_depot,
+                    customer_demand, vehicle_capacity, check_capacity=True):
+    """
+    Scores many solutions (every read of a sampleset, every cell of a sweep) in one pass,
+    counting errors like check_solution
+    Returns a dictionary with an array of error counts per solution for every constraint
+    """
+    num_customers = len(customer_demand)
+    num_vehicles = len(vehicle_capacity)
+    num_solutions = len(solutions)
+    sol, veh, i, j = solutions_to_arcs(solutions, num_vehicles)
+    num_nodes = max(num_customers+1, starting_depot+1, ending_depot+1, i.max(initial=0)+1, j.max(initial=0)+1)
+    group = sol*num_vehicles + veh
+    num_groups = num_solutions*num_vehicles
+    per_solution = lambda values, mask: np.bincount(sol[mask], weights=values[mask],
+                                                   minlength=num_solutions).astype(int)
+    per_vehicle = lambda failed: failed.reshape(num_solutions, num_vehicles).sum(axis=1)
+    
+    errors = {}
+    # Every customer is visited once
+    customer = (j >= 1) & (j <= num_customers)
+    visits = np.bincount(sol[customer]*num_customers + j[customer]-1,
+                         minlength=num_solutions*num_customers).reshape(num_solutions, num_customers)
+    errors["visits"] = (visits != 1).sum(axis=1)
+    
+    # Every vehicle starts and ends at the depots
+    starts = np.zeros(num_groups, dtype=bool)
+    starts[group[i == starting_depot]] = True
+    errors["starts"] = per_vehicle(~starts)
+    ends = np.zeros(num_groups, dtype=bool)
+    ends[group[j == ending_depot]] = True
+    errors["ends"] = per_vehicle(~ends)
+    
+    # Every node reached is left exactly once, and every node left is reached exactly once
+    moving = i != j
+    leaving = count_by(group[moving]*num_nodes + i[moving], group*num_nodes + j)
+    errors["dead_ends"] = per_solution(leaving != 1, j != ending_depot)
+    arriving = count_by(group[moving]*num_nodes + j[moving], group*num_nodes + i)
+    errors["impossible_starts"] = per_solution(arriving != 1, i != starting_depot)
+    
+    errors["subtours"] = per_vehicle(count_subtour_errors(group, i, j, num_groups, num_nodes))
+    
+    errors["capacity"] = np.zeros(num_solutions, dtype=int)
+    if check_capacity:
+        served = j != ending_depot
+        load = np.bincount(group[served], weights=np.asarray(customer_demand)[j[served]-1], minlength=num_groups)
+        errors["capacity"] = per_vehicle(load.reshape(num_solutions, num_vehicles) > np.asarray(vehicle_capacity))
+    return errors
@@ -0,0 +1,104 @@
+import numpy as np
+import dimod
+from scipy import sparse
+
+from collections import namedtuple
+
+QuboSize = namedtuple("QuboSize", ["variables", "quadratic_terms", "memory"])
+
+# Approximate peak bytes per variable or quadratic term while building and sampling,
+# measured on TSP QUBOs (dadk could not be measured and is assumed to be like pyqubo)
+BYTES_PER_TERM = {"sparse": 128, "pyqubo": 1400, "dadk": 1400}
+
+def squared_sum_penalty(indices, coefficients, constants):
+    """
+    Expands sum_g (constants[g] + sum_i coefficients[g][i]*x[indices[g][i]])**2 for binary x
+    Every row of indices is one group (one constraint)
+    Returns the COO arrays (rows, cols, values) and the constant offset
+    """
+    indices = np.atleast_2d(indices)
+    coefficients = np.broadcast_to(np.asarray(coefficients, dtype=float), indices.shape)
+    constants = np.broadcast_to(np.asarray(constants, dtype=float), (len(indices),))
+    # x**2 == x for binary variables, so the squares go to the diagonal
+    linear = coefficients*coefficients + 2*constants[:, None]*coefficients
+    i, j = np.triu_indices(indices.shape[1], 1)
+    rows = np.concatenate([indices.ravel(), indices[:, i].ravel()])
+    cols = np.concatenate([indices.ravel(), indices[:, j].ravel()])
+    values = np.concatenate([linear.ravel(), (2*coefficients[:, i]*coefficients[:, j]).ravel()])
+    return rows, cols, values, np.sum(constants*constants)
+
+def coo_to_qubo_matrix(rows, cols, values, num_variables):
+    """
+    Sums the COO terms into an upper triangular sparse QUBO matrix
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    upper_rows = np.minimum(rows, cols)
+    upper_cols = np.maximum(rows, cols)
+    return sparse.coo_matrix((values, (upper_rows, upper_cols)),
+                             shape=(num_variables, num_variables)).tocsr()
+
+def qubo_matrix_to_bqm(qubo, offset=0):
+    """
+    Builds a dimod BinaryQuadraticModel with variables 0..n-1 from a QUBO matrix
+    """
+    qubo = sparse.triu(qubo, format="coo")
+    linear = qubo.diagonal()
+    quadratic = qubo.row != qubo.col
+    return dimod.BinaryQuadraticModel.from_numpy_vectors(
+        linear, (qubo.row[quadratic], qubo.col[quadratic], qubo.data[quadratic]), offset, dimod.BINARY)
+
+def qubo_matrix_to_dict(qubo, labels=None):
+    """
+    Converts a QUBO matrix into the {(u, v): bias} dictionary used by the samplers
+    """
+    qubo = sparse.triu(qubo, format="coo")
+    if labels is None:
+        return {(int(i), int(j)): v for i, j, v in zip(qubo.row, qubo.col, qubo.data)}
+    return {(labels[i], labels[j]): v for i, j, v in zip(qubo.row, qubo.col, qubo.data)}
+
+def sampleset_to_array(sampleset, num_variables, labels=None):
+    """
+    Returns the samples of a sampleset with integer variables 0..n-1 as a
+    (num_samples, num_variables) array in variable order, together with the energies
+    labels maps other variable labels (like the names of PyQUBO variables) to their index
+    """
+    if labels is None:
+        index = np.asarray(sampleset.variables, dtype=int)
+    else:
+        index = np.array([labels[v] for v in sampleset.variables], dtype=int)
+    columns = np.empty(num_variables, dtype=int)
+    columns[index] = np.arange(len(sampleset.variables))
+    return sampleset.record.sample[:, columns], sampleset.record.energy
+
+def binary_coefficients(max_value):
+    """
+    Coefficients of a bounded binary encoding of the integers 0..max_value
+    The last coefficient is reduced so the bits can not add up to more than max_value
+    """
+    coefficients = []
+    while sum(coefficients) < max_value:
+        coefficients += [min(2**len(coefficients), max_value-sum(coefficients))]
+    return coefficients
+
+def pair_count(group_size):
+    """
+    Number of quadratic terms of a squared sum over group_size variables
+    """
+    return group_size*(group_size-1)//2
+
+def qubo_size(num_variables, quadratic_terms, backend="sparse"):
+    """
+    Returns the QuboSize with the approximate peak memory in bytes of building a QUBO
+    """
+    return QuboSize(num_variables, quadratic_terms, (num_variables + quadratic_terms)*BYTES_PER_TERM[backend])
+
+def check_memory_budget(size, memory_budget):
+    """
+    Raises MemoryError if the estimated size of a QUBO does not fit in memory_budget bytes
+    memory_budget=None disables the check
+    """
+    if memory_budget is not None and size.memory > memory_budget:
+        raise MemoryError("The QUBO needs about {:.1f} MB ({} variables, {} quadratic terms), "
+                          "the memory budget is {:.1f} MB".format(size.memory/2**20, size.variables,
+                                                                 size.quadratic_terms, memory_budget/2**20))
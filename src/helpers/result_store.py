@@ -0,0 +1,129 @@
+import csv
+import os
+import sqlite3
+import time
+from os.path import abspath, dirname
+
+import numpy as np
+
+RESULTS_DB = './results/results.db'
+# Seconds a writer waits for another process to finish its transaction
+BUSY_TIMEOUT = 60
+
+TABLES = {
+    "clustering_runs": [("run", "INTEGER"), ("experiment", "TEXT"), ("problem", "TEXT"), ("nodes", "INTEGER"),
+                        ("clusters", "INTEGER"), ("algorithm", "TEXT"), ("solver", "TEXT"), ("num_reads", "INTEGER"),
+                        ("clustering_time", "REAL"), ("unassigned_nodes", "INTEGER"), ("demand_errors", "INTEGER"),
+                        ("silhouette", "REAL"), ("qubo_length", "INTEGER"), ("energy", "REAL"),
+                        ("constraint_1", "REAL"), ("constraint_2", "REAL")],
+    "routing_runs": [("run", "INTEGER"), ("experiment", "TEXT"), ("problem", "TEXT"), ("nodes", "INTEGER"),
+                     ("vehicles", "INTEGER"), ("algorithm", "TEXT"), ("solver", "TEXT"), ("num_reads", "INTEGER"),
+                     ("clustering_time", "REAL"), ("routing_time", "REAL"), ("errors", "INTEGER"), ("distance", "REAL"),
+                     ("energy", "REAL"), ("constraint_1", "REAL"), ("constraint_2", "REAL")],
+}
+# Columns of the CSV files the parameter scripts used to write, for import_csv
+CSV_COLUMNS = {
+    "clustering_runs": {"Problem": "problem", "Nodes": "nodes", "Clusters": "clusters", "Algorithm": "algorithm",
+                        "Solver": "solver", "Num Reads/Iters": "num_reads", "Time": "clustering_time",
+                        "Unassigned Nodes": "unassigned_nodes", "Demand Errors": "demand_errors",
+                        "Silhouette": "silhouette", "QUBO length": "qubo_length", "Energy": "energy",
+                        "Constraint 1": "constraint_1", "Constraint 2": "constraint_2"},
+    "routing_runs": {"Problem": "problem", "Nodes": "nodes", "Vehicles": "vehicles", "Algorithm": "algorithm",
+                     "Solver": "solver", "Num Reads/Iters": "num_reads", "Time": "routing_time", "Errors": "errors",
+                     "Distance": "distance", "Energy": "energy", "Constraint 1": "constraint_1",
+                     "Constraint 2": "constraint_2"},
+}
+CASTS = {"INTEGER": int, "REAL": float, "TEXT": str}
+
+connections = {}
+
+def connect(path=RESULTS_DB):
+    """
+    Returns the connection of this process to the store, creating the database and its tables
+    Every process (pool workers included) opens its own connection, and WAL lets them append
+    while others read
+    """
+    key = (os.getpid(), abspath(path))
+    if key not in connections:
+        os.makedirs(dirname(abspath(path)), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            for table, columns in TABLES.items():
+                conn.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+                    table, ", ".join("{} {}".format(name, sql_type) for name, sql_type in columns)))
+                conn.execute("CREATE INDEX IF NOT EXISTS {0}_problem ON {0} (experiment, problem, run)".format(table))
+        connections[key] = conn
+    return connections[key]
+
+def new_run():
+    """
+    Id of a sweep, the heatmaps use the latest run of every problem
+    """
+    return time.time_ns()
+
+def to_column(value, sql_type):
+    if value is None or value == "":
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    return CASTS[sql_type](value)
+
+def append_rows(table, rows, path=RESULTS_DB):
+    """
+    Appends rows (dictionaries by column name, missing columns are NULL) in one transaction
+    """
+    columns = TABLES[table]
+    values = [tuple(to_column(row.get(name), sql_type) for name, sql_type in columns) for row in rows]
+    conn = connect(path)
+    with conn:
+        conn.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+            table, ", ".join(name for name, _ in columns), ", ".join("?"*len(columns))), values)
+
+def import_csv(table, experiment, csv_file, path=RESULTS_DB):
+    """
+    Loads a CSV written by the parameter scripts as a new run of its problem
+    """
+    with open(csv_file, newline='') as f:
+        rows = [{CSV_COLUMNS[table][key]: value for key, value in row.items() if key in CSV_COLUMNS[table]}
+                for row in csv.DictReader(f)]
+    run = new_run()
+    for row in rows:
+        row.update(run=run, experiment=experiment)
+    append_rows(table, rows, path)
+
+def query_parameter_grid(table, experiment, problems, metrics, normalized=(), path=RESULTS_DB):
+    """
+    Averages metrics over the latest run of every problem for each pair of constraint multipliers
+    Metrics in normalized are min-max scaled within each problem first (kept as they are when
+    their maximum is 0) and every value is rounded to 2 decimals before averaging
+    Returns the sorted constraint 1 and 2 multipliers and a constraint 1 x constraint 2 grid per metric
+    """
+    scaled = []
+    for metric in metrics:
+        if metric in normalized:
+            spread = "NULLIF(MAX({0}) OVER w - MIN({0}) OVER w, 0)".format(metric)
+            scaled += ["CASE WHEN MAX({0}) OVER w = 0 THEN {0} ELSE ROUND(({0} - MIN({0}) OVER w)*1.0/{1}, 2) END AS {0}".format(metric, spread)]
+        else:
+            scaled += [metric]
+    marks = ", ".join("?"*len(problems))
+    query = """
+        WITH latest AS (SELECT problem, MAX(run) AS run FROM {table} WHERE experiment = ? AND problem IN ({marks}) GROUP BY problem),
+        sweep AS (SELECT t.* FROM {table} t JOIN latest ON t.problem = latest.problem AND t.run = latest.run WHERE t.experiment = ?),
+        scaled AS (SELECT constraint_1, constraint_2, {scaled} FROM sweep WINDOW w AS (PARTITION BY problem))
+        SELECT constraint_1, constraint_2, {averages} FROM scaled GROUP BY constraint_1, constraint_2 ORDER BY constraint_1, constraint_2
+    """.format(table=table, marks=marks, scaled=", ".join(scaled),
+               averages=", ".join("AVG({})".format(metric) for metric in metrics))
+    rows = connect(path).execute(query, [experiment] + list(problems) + [experiment]).fetchall()
+    if not rows:
+        raise ValueError("No {} results for {}".format(experiment, ", ".join(problems)))
+    constraint_1 = sorted({row[0] for row in rows})
+    constraint_2 = sorted({row[1] for row in rows})
+    grids = {metric: np.full((len(constraint_1), len(constraint_2)), np.nan) for metric in metrics}
+    for row in rows:
+        for metric, value in zip(metrics, row[2:]):
+            grids[metric][constraint_1.index(row[0]), constraint_2.index(row[1])] = np.nan if value is None else value
+    # Whole multipliers are shown without decimals
+    labels = lambda values: [int(v) if float(v).is_integer() else v for v in values]
+    return labels(constraint_1), labels(constraint_2), grids
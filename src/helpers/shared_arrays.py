@@ -0,0 +1,38 @@
+import numpy as np
+
+from multiprocessing import shared_memory, resource_tracker
+
+def create_shared_array(array, dtype=None):
+    """
+    Copies an array into a new shared memory block
+    Returns the block (which must be kept alive and unlinked by the owner),
+    a view of the block and the spec needed to attach to it from another process
+    """
+    array = np.asarray(array, dtype=dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+    return block, shared, (block.name, array.shape, array.dtype.str)
+
+def attach_shared_array(spec):
+    """
+    Attaches to a shared memory block created by create_shared_array
+    Returns the block and a view of it, no data is copied
+    """
+    name, shape, dtype = spec
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before python 3.13 attaching registers the block in the resource tracker,
+        # which would unlink it when this process exits
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, "shared_memory")
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def release_shared_arrays(blocks):
+    """
+    Closes and unlinks the shared memory blocks owned by this process
+    """
+    for block in blocks:
+        block.close()
+        block.unlink()
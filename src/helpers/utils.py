@@ -2,61 +2,223 @@ import numpy as np
 import math
 import matplotlib.pyplot as plt
 
-import xmltodict
-import pandas as pd
-from scipy.spatial import distance_matrix
+from xml.etree import ElementTree
 np.set_printoptions(suppress=True,
                     formatter={'float_kind': '{:.2f}'.format})
 
-from os import listdir
-from os.path import isfile, join
+import os
+import shutil
+import hashlib
+import tempfile
+from os import listdir, makedirs
+from os.path import isfile, isdir, join, dirname
 
 import diptest
 from sklearn.metrics import pairwise_distances
 
-def read_xml(path, cost_mod, dest_depot=False, source_depot=False):
+from helpers.DistanceMatrix import DistanceMatrix, euclidean_distances
+from helpers.result_store import RESULTS_DB, query_parameter_grid
+
+INSTANCE_CACHE_DIR = '.cache'
+# Changing how instances are parsed must change the version so old cache entries are not used
+INSTANCE_CACHE_VERSION = b'read_xml-1'
+INSTANCE_CACHE_FIELDS = ['customer_demand', 'vehicle_capacity', 'locations', 'distances']
+
+def read_xml(path, cost_mod, dest_depot=False, source_depot=False, cache_dir=INSTANCE_CACHE_DIR,
+             precision="float64", condensed=False, lazy=False):
     """
-    Reads data from an xml file 
+    Reads data from an xml file, or a CVRPLIB .vrp file
+    The parsed instance is cached in cache_dir (relative to the folder of the file) keyed by a hash
+    of the file contents, cache_dir=None always parses the file, and so does a folder that
+    cannot be written
+    The distances with and without depots are views over a single stored matrix
+    precision, condensed and lazy select the storage of the distances (see DistanceMatrix), any
+    other than the default dense float64 returns a DistanceMatrix instead of an array
     """
-    with open(path, 'r', encoding='utf-8') as file:
-        my_xml = file.read()
+    instance = None
+    if cache_dir is not None:
+        instance_dir = join(dirname(path), cache_dir, hash_file(path))
+        instance = load_instance_cache(instance_dir)
+    if instance is None:
+        if path.endswith('.vrp'):
+            instance = parse_vrp(path)
+        else:
+            instance = parse_xml(path)
+        if cache_dir is not None:
+            try:
+                save_instance_cache(instance_dir, instance)
+            except OSError:
+                # The folder cannot be written (e.g. read only data), the instance is used uncached
+                pass
+    customer_demand, vehicle_capacity, locations, distances = instance
     
-    my_dict = xmltodict.parse(my_xml)
+    # locations and distances are ordered as [depot] + customers + [depot]
+    start = 0 if source_depot else 1
+    end = len(locations) if dest_depot else len(locations)-1
+    customer_locations = locations[start:end].tolist()
+    depot = locations[0].tolist()
     
-    customer_demand = []
-    for request in my_dict['instance']['requests']['request']:
-        customer_demand += [math.floor(float(request['quantity']))]
-        
-    vehicle_capacity = []
-    starting_depot = 0
-    if type(my_dict['instance']['fleet']['vehicle_profile'])==type([]):
-        for vehicle in my_dict['instance']['fleet']['vehicle_profile']:
-            vehicle_capacity += [math.floor(float(vehicle['capacity']))]
-    if type(my_dict['instance']['fleet']['vehicle_profile'])==type({}):
-        vehicle_capacity = [math.floor(float(my_dict['instance']['fleet']['vehicle_profile']['capacity']))]
-        starting_depot = my_dict['instance']['fleet']['vehicle_profile']['departure_node']
-        
+    if lazy:
+        distances = DistanceMatrix.from_locations(locations[start:end], precision, lazy=True)
+    elif precision != "float64" or condensed:
+        distances = DistanceMatrix.from_matrix(distances[start:end, start:end], precision, condensed)
+    else:
+        distances = distances[start:end, start:end]
+
+    return customer_demand.tolist(), vehicle_capacity.tolist(), distances, customer_locations, depot
+
+def hash_file(path, chunk_size=2**20):
+    """
+    Returns the key of a file in the instance cache
+    """
+    file_hash = hashlib.blake2b(digest_size=16, person=INSTANCE_CACHE_VERSION)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def euclidean_distance_matrix(locations):
+    """
+    Same values as scipy's distance_matrix, computed per coordinate without the row loop
+    """
+    nodes = np.arange(len(locations))
+    return euclidean_distances(locations, nodes[:, None], nodes[None, :])
+
+def grow(array, size):
+    """
+    Returns array with room for at least size rows, doubling its length when it is full
+    """
+    if size <= len(array):
+        return array
+    grown = np.empty((max(size, 2*len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def parse_xml(path):
+    """
+    Parses a VRP-REP xml instance element by element, without building the whole tree
+    Returns the demands, the capacities and the locations and distances of [depot] + customers + [depot]
+    Tags are matched in any namespace, so documents with a default xmlns parse the same
+    """
+    node_ids = []
+    node_types = np.empty(1024, dtype=int)
+    node_locations = np.empty((1024, 2))
+    customer_demand = np.empty(1024, dtype=int)
+    num_requests = 0
+    profile_capacity = []
+    profile_departure = []
     
-    vehicle_capacity = vehicle_capacity * math.ceil(sum(customer_demand)/sum(vehicle_capacity))
+    for _, element in ElementTree.iterparse(path, events=('end',)):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'node':
+            node_types = grow(node_types, len(node_ids)+1)
+            node_locations = grow(node_locations, len(node_ids)+1)
+            node_types[len(node_ids)] = int(element.get('type'))
+            node_locations[len(node_ids)] = [float(element.findtext('{*}cx')), float(element.findtext('{*}cy'))]
+            node_ids += [element.get('id')]
+            element.clear()
+        elif tag == 'request':
+            customer_demand = grow(customer_demand, num_requests+1)
+            customer_demand[num_requests] = math.floor(float(element.findtext('{*}quantity')))
+            num_requests += 1
+            element.clear()
+        elif tag == 'vehicle_profile':
+            profile_capacity += [math.floor(float(element.findtext('{*}capacity')))]
+            profile_departure += [element.findtext('{*}departure_node')]
+            element.clear()
+    customer_demand = customer_demand[:num_requests]
+    node_types = node_types[:len(node_ids)]
+    node_locations = node_locations[:len(node_ids)]
     
+    # A single vehicle profile also sets the depot
+    starting_depot = profile_departure[0] if len(profile_capacity) == 1 else None
+    is_depot = (node_types == 0) | (np.array(node_ids) == starting_depot)
+    # The last depot node is the depot
+    depot = node_locations[np.flatnonzero(is_depot)[-1]]
+    customer_locations = node_locations[~is_depot]
     
-    customer_locations = []
-    depot = []
-    for customer in my_dict['instance']['network']['nodes']['node']:
-        if customer['@type']=="1" and customer['@id'] != starting_depot:
-            customer_locations += [[float(customer['cx']),float(customer['cy'])]]
-        if customer['@type']=="0" or customer['@id'] == starting_depot:
-            depot = [float(customer['cx']),float(customer['cy'])]
-    if source_depot:
-        customer_locations = [depot]+customer_locations
-    if dest_depot:
-        customer_locations = customer_locations+[depot]
-        
-    df = pd.DataFrame(customer_locations, columns=['xcord','ycord'])
+    vehicle_capacity = profile_capacity * math.ceil(customer_demand.sum()/sum(profile_capacity))
+    
+    locations = np.vstack([depot, customer_locations, depot])
+    distances = euclidean_distance_matrix(locations)
+
+    return customer_demand, np.array(vehicle_capacity), locations, distances
+
+def parse_vrp(path):
+    """
+    Parses a CVRPLIB .vrp instance (EUC_2D, one depot) line by line into preallocated arrays
+    Returns the same arrays as parse_xml
+    """
+    dimension = None
+    capacity = None
+    section = None
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            fields = line.replace(':', ' : ', 1).split()
+            if not fields:
+                continue
+            keyword = fields[0].upper()
+            if keyword == 'DIMENSION':
+                dimension = int(fields[-1])
+                node_locations = np.empty((dimension, 2))
+                node_demand = np.zeros(dimension, dtype=int)
+                depots = []
+            elif keyword == 'CAPACITY':
+                capacity = math.floor(float(fields[-1]))
+            elif keyword in ('NODE_COORD_SECTION', 'DEMAND_SECTION', 'DEPOT_SECTION'):
+                section = keyword
+            elif keyword == 'EOF':
+                break
+            elif section == 'NODE_COORD_SECTION' and keyword.lstrip('-').isdigit():
+                node_locations[int(fields[0])-1] = [float(fields[1]), float(fields[2])]
+            elif section == 'DEMAND_SECTION' and keyword.lstrip('-').isdigit():
+                node_demand[int(fields[0])-1] = math.floor(float(fields[1]))
+            elif section == 'DEPOT_SECTION' and keyword.lstrip('-').isdigit():
+                if int(fields[0]) > 0:
+                    depots += [int(fields[0])-1]
+            else:
+                section = None
+    if dimension is None or capacity is None:
+        raise ValueError("{} is missing DIMENSION or CAPACITY".format(path))
+    
+    depot = depots[0] if depots else 0
+    is_customer = np.arange(dimension) != depot
+    customer_demand = node_demand[is_customer]
     
-    distances = distance_matrix(df.values, df.values)
+    vehicle_capacity = [capacity] * math.ceil(customer_demand.sum()/capacity)
+    
+    locations = np.vstack([node_locations[depot], node_locations[is_customer], node_locations[depot]])
+    distances = euclidean_distance_matrix(locations)
 
-    return customer_demand, vehicle_capacity, distances, customer_locations, depot
+    return customer_demand, np.array(vehicle_capacity), locations, distances
+
+def load_instance_cache(instance_dir):
+    """
+    Loads a cached instance, the locations and distances are memory mapped copy-on-write, so
+    they can be written like a parsed instance without changing the cache
+    Returns None if the instance is not cached
+    """
+    if not isdir(instance_dir):
+        return None
+    return tuple(np.load(join(instance_dir, name+'.npy'), mmap_mode='c') for name in INSTANCE_CACHE_FIELDS)
+
+def save_instance_cache(instance_dir, instance):
+    """
+    Writes the instance to a temporary folder and renames it, so readers never see a partial entry
+    """
+    makedirs(dirname(instance_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=dirname(instance_dir))
+    try:
+        for name, array in zip(INSTANCE_CACHE_FIELDS, instance):
+            np.save(join(tmp_dir, name+'.npy'), array)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_dir, instance_dir)
+    except OSError:
+        # Another process cached the same instance first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 def powerset(seq):
@@ -86,84 +248,159 @@ def process_solution(solution, num_customers, cluster):
     Converts the solution obtained from the annealer into a more readable format
     Returns an array of tuples indicating the path
     """
-    solution_processed = []
-    tuples = []
-    for i in range(num_customers+2):
-        for j in range(num_customers+2):
-                tuples += [(i,j)]
-    
-    for i, val in enumerate(solution.sample.values()):
-        if val==1 and i < len(tuples):
-            x = tuples[i][0]
-            if x==0 or x==num_customers+1:
-                x = 0
-            else:
-                x = cluster[tuples[i][0]-1]+1
-            y = tuples[i][1]
-            if y==0 or y==num_customers+1:
-                y = 0
-            else:
-                y = cluster[tuples[i][1]-1]+1
-            solution_processed += [(x,y)]
-    return solution_processed
+    num_vertices = num_customers+2
+    bits = sample_to_array(solution.sample.values())[:num_vertices*num_vertices]
+    i, j = np.divmod(np.flatnonzero(bits), num_vertices)
+    # Both depots are node 0
+    nodes = cluster_nodes(cluster, dest_depot=True)
+    return list(zip(nodes[i].tolist(), nodes[j].tolist()))
+
+def sample_to_array(sample):
+    """
+    Converts the values of a sample, in variable order, into a bit array
+    """
+    return np.fromiter(sample, dtype=np.int8)
+
+def decode_tsp_samples(samples, num_customers, cluster):
+    """
+    Decodes a (num_samples, (num_customers+1)**2) array of TSP_Solver samples in one pass
+    Returns the node at every position of every sample and whether each sample is a valid cycle
+    (one node per position and one position per node)
+    """
+    n = num_customers+1
+    x = np.asarray(samples)[:, :n*n].reshape(-1, n, n)
+    valid = (x.sum(axis=2) == 1).all(axis=1) & (x.sum(axis=1) == 1).all(axis=1)
+    return cluster_nodes(cluster)[x.argmax(axis=2)], valid
+
+def repair_tsp_tour(positions, distances):
+    """
+    Turns the local node at every position of a TSP_Solver sample (-1 for none) into a tour of
+    all the local nodes starting at 0: repeated nodes keep their first position and the missing
+    nodes are inserted where they add the least distance
+    """
+    distances = np.asarray(distances)
+    tour = [0] + [v for v in dict.fromkeys(np.asarray(positions).tolist()) if v > 0]
+    for v in np.setdiff1d(np.arange(1, len(positions)), tour):
+        # Inserting v after tour[p], the last option appends it at the end
+        previous = np.array(tour)
+        following = np.array(tour[1:])
+        added = distances[previous, v]
+        added[:-1] += distances[v, following] - distances[previous[:-1], following]
+        p = int(np.argmin(added))
+        tour.insert(p+1, int(v))
+    return tour
+
+def tsp_tour_lengths(tours, distances):
+    """
+    Lengths of (num_tours, n) local tours on a cluster distance matrix with the destination
+    depot as its last node, including the way back to it
+    """
+    distances = np.asarray(distances)
+    tours = np.asarray(tours)
+    return distances[tours[:, :-1], tours[:, 1:]].sum(axis=1) + distances[tours[:, -1], -1]
+
+def best_tsp_sample(samples, energies, distances):
+    """
+    Repairs every distinct TSP_Solver sample and keeps the shortest tour (the lowest energy on ties)
+    Returns the repaired sample in variable order and the energy of the read it comes from
+    """
+    n = len(distances)-1
+    samples, reads = np.unique(np.asarray(samples)[:, :n*n], axis=0, return_index=True)
+    energies = np.asarray(energies)[reads]
+    x = samples.reshape(-1, n, n)
+    positions = np.where(x.any(axis=2), x.argmax(axis=2), -1)
+    tours = np.array([repair_tsp_tour(p, distances) for p in positions])
+    best = np.lexsort((energies, tsp_tour_lengths(tours, distances)))[0]
+    sample = np.zeros((n, n), dtype=np.int8)
+    sample[np.arange(n), tours[best]] = 1
+    return sample.ravel(), energies[best]
+
+def decode_vrp_samples(samples, num_customers, num_vehicles):
+    """
+    Reshapes a (num_samples, num_variables) array of full VRP samples into the
+    (num_samples, num_customers+2, num_customers+2, num_vehicles) arc variables x[i][j][k]
+    """
+    num_vertices = num_customers+2
+    shape = (num_vertices, num_vertices, num_vehicles)
+    return np.asarray(samples)[:, :np.prod(shape)].reshape((-1,) + shape)
+
+def vrp_sample_routes(x):
+    """
+    Returns the (i, j) arcs used by every vehicle in the arc variables x[i][j][k] of one sample
+    """
+    i, j, k = np.nonzero(x)
+    return [list(zip(i[k==v].tolist(), j[k==v].tolist())) for v in range(x.shape[2])]
 
 def compute_cluster_distances(customer_locations, cluster, dest_depot=True):
     """
     Computes the distance matrix for the specified cluster
     """
-    inf = 9999999
     locations = [customer_locations[0]] + [customer_locations[i+1] for i in cluster]
     if dest_depot:
         locations += [customer_locations[0]]
-    df = pd.DataFrame(locations, columns=['xcord','ycord'])
-    cluster_distances = distance_matrix(df.values, df.values)
-    for i,line in enumerate(cluster_distances):
-        for j,y in enumerate(line):
-            cluster_distances[i][0] = inf
-            if i == len(cluster_distances)-1:
-                cluster_distances[i][j] = inf
-            if y == 0.0:
-                cluster_distances[i][j] = inf
+    cluster_distances = euclidean_distance_matrix(np.array(locations, dtype=float))
+    return mask_cluster_distances(cluster_distances)
+
+def mask_cluster_distances(cluster_distances, inf=9999999):
+    """
+    Forbids returning to the start, leaving the end and zero length arcs (in place)
+    """
+    cluster_distances[cluster_distances == 0.0] = inf
+    cluster_distances[:, 0] = inf
+    cluster_distances[-1, :] = inf
     return cluster_distances
 
+def cluster_nodes(cluster, dest_depot=False):
+    """
+    Indices of the depot and the customers of a cluster in the distance matrix returned by read_xml
+    with source_depot (depot at 0 and customer i at i+1)
+    """
+    nodes = [0] + [i+1 for i in cluster]
+    if dest_depot:
+        nodes += [0]
+    return np.array(nodes, dtype=int)
+
+def get_cluster_distances(distances, cluster, dest_depot=True):
+    """
+    Same as compute_cluster_distances, gathered from the distance matrix of the whole problem
+    """
+    nodes = cluster_nodes(cluster, dest_depot)
+    cluster_distances = np.asarray(distances[np.ix_(nodes, nodes)], dtype=float)
+    return mask_cluster_distances(cluster_distances)
+
+def get_tsp_cluster_distances(distances, cluster):
+    """
+    Same as compute_tsp_cluster_distances, gathered from the distance matrix of the whole problem
+    """
+    nodes = cluster_nodes(cluster)
+    return np.asarray(distances[np.ix_(nodes, nodes)], dtype=float)
+
 def compute_tsp_cluster_distances(customer_locations, cluster):
     """
     Computes the distance matrix for the specified cluster
     """
     locations = [customer_locations[0]] + [customer_locations[i+1] for i in cluster]
-    df = pd.DataFrame(locations, columns=['xcord','ycord'])
-    cluster_distances = distance_matrix(df.values, df.values)
+    cluster_distances = euclidean_distance_matrix(np.array(locations, dtype=float))
     return cluster_distances
 
 def get_distances_wo_depots(distances):
     """
     Removes the depot from the distance matrix
+    Returns a view of distances instead of a copy
     """
-    distances_wo_depots = []
-    for d in distances[1:-1]:
-        line = []
-        for e in d[1:-1]:
-            line += [e]
-        distances_wo_depots += [line]
-    return distances_wo_depots
+    if isinstance(distances, DistanceMatrix):
+        return distances.submatrix(slice(1, -1))
+    return np.asarray(distances)[1:-1, 1:-1]
 
 def process_tsp_solution(solution, num_customers, cluster):
-    tuples = []
-    for i in range(num_customers+1):
-        for j in range(num_customers+1):
-            tuples += [(i,j)]
-        
-    path = []
-    for i, x in enumerate(solution):
-        if x==1:
-            if tuples[i][1]==0:
-                path += [0]
-            else:
-                path += [cluster[tuples[i][1]-1]+1]
-    path += [0]
-    solution_processed = []
-    for i, elem in enumerate(path[:-1]):
-        solution_processed += [(elem, path[i+1])]
+    """
+    Converts a TSP_Solver sample into the visited nodes and the list of arcs
+    """
+    n = num_customers+1
+    bits = sample_to_array(solution)[:n*n]
+    # Variable j*n + v is node v at position j
+    path = cluster_nodes(cluster)[np.flatnonzero(bits) % n].tolist() + [0]
+    solution_processed = list(zip(path[:-1], path[1:]))
         
     return path, solution_processed
 
@@ -188,63 +425,79 @@ def count_clusters_with_more_demand(clusters, num_clusters, capacity, demand):
             error_clusters += 1
     return error_clusters
 
+def draw_arcs(ax, routes, data, depot, colors):
+    """
+    Draws the arcs of all the routes (node 0 is the depot, node i is data[i-1]) as arrows
+    colored by route, with a single quiver call
+    """
+    points = np.vstack([np.asarray(depot, dtype=float)[:2], np.asarray(data, dtype=float)[:, :2]])
+    arcs = [(i, j, k) for k, route in enumerate(routes) for i, j in route]
+    if not arcs:
+        return
+    arcs = np.array(arcs, dtype=int)
+    start = points[arcs[:, 0]]
+    end = points[arcs[:, 1]]
+    ax.quiver(start[:, 0], start[:, 1], end[:, 0]-start[:, 0], end[:, 1]-start[:, 1], color=colors[arcs[:, 2]],
+              angles='xy', scale_units='xy', scale=1, width=0.003, headwidth=5, headlength=8)
+
 def plot_data(clusters, num_clusters, capacity, data, depot, demand, solution=None, show_demand=False, 
-              plot_numbers=False, show_cluster_demand=False, save_file=None):
+              plot_numbers=False, show_cluster_demand=False, save_file=None, renderer=None):
+        """
+        Plots the customers colored by cluster (one scatter per cluster) and the routes of solution
+        renderer: a RenderWorker that draws and saves the figure in the background
+        data has one row per label of clusters (customers only, without depots)
+        """
+        if len(data) != len(clusters):
+            # Checked before submitting, an error in the renderer would only be printed
+            raise ValueError("plot_data got {} locations for {} cluster labels".format(len(data), len(clusters)))
+        if renderer is not None:
+            renderer.submit(plot_data, clusters, num_clusters, capacity, data, depot, demand, solution, show_demand,
+                            plot_numbers, show_cluster_demand, save_file)
+            return
         colors =  np.array(np.random.randint(0, 255, size =(num_clusters, 4)))/255
         colors[:,3]=1
         fig, ax = plt.subplots(1,1)
-        cluster_demand = [0]*num_clusters
-        cluster_cx = [0]*num_clusters
-        cluster_cy = [0]*num_clusters
-        cluster_count = [0]*num_clusters
-        for i,x in enumerate(clusters):
-            if x!=-1:
-                cluster_demand[x]+=demand[i]
-                cluster_cx[x] += data[i][0]
-                cluster_cy[x] += data[i][1]
-                cluster_count[x] += 1
-                
-        for i,x in enumerate(cluster_cx):
-            cluster_cx[i] /= cluster_count[i]
-            cluster_cy[i] /= cluster_count[i]
-
-        for i, x in enumerate(clusters):
-            if x == -1:
-                plt.scatter(data[i][0], data[i][1], marker="s", s=50, color="black")
-                ax.annotate(demand[i], (data[i][0], data[i][1]))
-            else:
-                if cluster_demand[x]>capacity:
-                    marker = "X"
-                else:
-                    marker = "o"
-                plt.scatter(data[i][0], data[i][1], marker=marker, s=50, color=colors[x])
-                if solution is not None:
-                    for path in solution[x]:
-                        if path[0]==0:
-                            A = depot
-                        else:
-                            A = data[path[0]-1]
-                        if path[1]==0:
-                            B = depot
-                        else:
-                            B = data[path[1]-1]
-                        plt.arrow(A[0], A[1], B[0]-A[0],B[1]-A[1], head_width=1, 
-                                length_includes_head=True,color=colors[x])
+        points = np.asarray(data, dtype=float)
+        labels = np.asarray(clusters, dtype=int)
+        demand = np.asarray(demand)
+        assigned = labels != -1
+        cluster_demand = np.zeros(num_clusters, dtype=demand.dtype)
+        np.add.at(cluster_demand, labels[assigned], demand[assigned])
+        cluster_count = np.bincount(labels[assigned], minlength=num_clusters)
+        cluster_cx = np.bincount(labels[assigned], weights=points[assigned, 0], minlength=num_clusters)
+        cluster_cy = np.bincount(labels[assigned], weights=points[assigned, 1], minlength=num_clusters)
+
+        unassigned = np.flatnonzero(~assigned)
+        if len(unassigned):
+            ax.scatter(points[unassigned, 0], points[unassigned, 1], marker="s", s=50, color="black")
+        for i in unassigned:
+            ax.annotate(demand[i], (points[i][0], points[i][1]))
+        for k in range(num_clusters):
+            members = labels == k
+            if not members.any():
+                continue
+            marker = "X" if cluster_demand[k]>capacity else "o"
+            ax.scatter(points[members, 0], points[members, 1], marker=marker, s=50, color=colors[k])
+        
+        if solution is not None:
+            # Routes of empty clusters are not drawn
+            draw_arcs(ax, [route if cluster_count[k] else [] for k, route in enumerate(solution[:num_clusters])],
+                      points, depot, colors)
         
-        plt.scatter(depot[0], depot[1], marker="o", s=50, color='black')
+        ax.scatter(depot[0], depot[1], marker="o", s=50, color='black')
         
         if show_cluster_demand:
-            for i,x in enumerate(cluster_cx):
-                ax.annotate(cluster_demand[i], (cluster_cx[i], cluster_cy[i]))
+            for i in np.flatnonzero(cluster_count):
+                ax.annotate(cluster_demand[i], (cluster_cx[i]/cluster_count[i], cluster_cy[i]/cluster_count[i]))
         
         if show_demand:
             for i, txt in enumerate(demand):
-                if clusters[i] != -1:
-                    ax.annotate(txt, (data[i][0], data[i][1]))
+                if labels[i] != -1:
+                    ax.annotate(txt, (points[i][0], points[i][1]))
                 
         if plot_numbers:
-            for i in range(len(data)):
-                ax.annotate(i, (data[i][0], data[i][1]))
+            for i in range(len(points)):
+                ax.annotate(i, (points[i][0], points[i][1]))
                 
         if save_file:
             if not save_file.endswith(".png"):
@@ -279,49 +532,21 @@ def calculate_clusterability(data, plot=True, save_file=None):
         plt.close()
     return dip, pval
 
-def plot_clustering_parameter_heatmaps(problem_name, csv_file, save_file=None):
-    if type(csv_file) == str:
-        df = pd.read_csv(csv_file)
-
-        constraint_1 = df['Constraint 1'].unique()
-        constraint_2 = df['Constraint 2'].unique()
-        len_constraint_2 = len(constraint_2)
-        len_constraint_1 = len(constraint_1)
-
-        node_errors = np.array(df['Unassigned Nodes'].to_list()).reshape((len_constraint_1, len_constraint_2))
-        demand_errors = np.array(df['Demand Errors'].to_list()).reshape((len_constraint_1, len_constraint_2))
-        silhouette = np.array(df['Silhouette'].to_list()).reshape((len_constraint_1, len_constraint_2))
-
-        rsilhouette = np.around(silhouette, 2)
+def plot_clustering_parameter_heatmaps(problem_name, problems, save_file=None, store=RESULTS_DB):
+    """
+    Heatmaps of the latest QUBO clustering multiplier sweep of a problem in the result store,
+    a list of problems averages their results scaled to [0, 1] within each problem
+    """
+    metrics = ["unassigned_nodes", "demand_errors", "silhouette"]
+    if type(problems) == str:
+        constraint_1, constraint_2, grids = query_parameter_grid("clustering_runs", "qubo_clustering_parameters",
+                                                                 [problems], metrics, path=store)
     else:
-        all_node_errors = []
-        all_demand_errors = []
-        all_silhouette = []
-        for csv_f in csv_file:
-            df = pd.read_csv(csv_f)
-            
-            constraint_1 = df['Constraint 1'].unique()
-            constraint_2 = df['Constraint 2'].unique()
-            len_constraint_2 = len(constraint_2)
-            len_constraint_1 = len(constraint_1)
-            
-            norm_node_errors = (df['Unassigned Nodes']-df['Unassigned Nodes'].min())/(df['Unassigned Nodes'].max()-df['Unassigned Nodes'].min())
-            if df['Demand Errors'].max() != 0:
-                norm_demand_errors = (df['Demand Errors']-df['Demand Errors'].min())/(df['Demand Errors'].max()-df['Demand Errors'].min())
-            else:
-                norm_demand_errors = df['Demand Errors']
-            norm_silhouette = (df['Silhouette']-df['Silhouette'].min())/(df['Silhouette'].max()-df['Silhouette'].min())
-            node_errors = np.around(np.array(norm_node_errors.to_list()),2).reshape((len_constraint_1, len_constraint_2))
-            demand_errors = np.around(np.array(norm_demand_errors.to_list()),2).reshape((len_constraint_1, len_constraint_2))
-            silhouette = np.around(np.array(norm_silhouette.to_list()),2).reshape((len_constraint_1, len_constraint_2))
-            
-            all_node_errors += [node_errors]
-            all_demand_errors += [demand_errors]
-            all_silhouette += [silhouette]
-        
-        node_errors = np.around(np.average(np.array(all_node_errors), axis=0), 2)
-        demand_errors = np.around(np.average(np.array(all_demand_errors), axis=0), 2)
-        rsilhouette = np.around(np.average(np.array(all_silhouette), axis=0),2)
+        constraint_1, constraint_2, grids = query_parameter_grid("clustering_runs", "qubo_clustering_parameters",
+                                                                 problems, metrics, normalized=metrics, path=store)
+    node_errors = np.around(grids["unassigned_nodes"], 2)
+    demand_errors = np.around(grids["demand_errors"], 2)
+    rsilhouette = np.around(grids["silhouette"], 2)
         
     fig, ax = plt.subplots(nrows=1, ncols=3, figsize=(10,4))
 
@@ -384,44 +609,20 @@ def plot_clustering_parameter_heatmaps(problem_name, csv_file, save_file=None):
 
     plt.close()
     
-def plot_routing_parameter_heatmaps(problem_name, csv_file, save_file=None):
-    if type(csv_file) == str:
-        df = pd.read_csv(csv_file)
-
-        constraint_1 = df['Constraint 1'].unique()
-        constraint_2 = df['Constraint 2'].unique()
-        len_constraint_2 = len(constraint_2)
-        len_constraint_1 = len(constraint_1)
-
-        errors = np.array(df['Errors'].to_list()).reshape((len_constraint_1, len_constraint_2))
-        distance = np.array(df['Distance'].to_list()).reshape((len_constraint_1, len_constraint_2))
-
-        rdistance = np.around(distance, 2)
+def plot_routing_parameter_heatmaps(problem_name, problems, save_file=None, store=RESULTS_DB):
+    """
+    Heatmaps of the latest QUBO routing multiplier sweep of a problem in the result store,
+    a list of problems averages their results scaled to [0, 1] within each problem
+    """
+    metrics = ["errors", "distance"]
+    if type(problems) == str:
+        constraint_1, constraint_2, grids = query_parameter_grid("routing_runs", "qubo_routing_parameters",
+                                                                 [problems], metrics, path=store)
     else:
-        all_errors = []
-        all_distance = []
-        for csv_f in csv_file:
-            df = pd.read_csv(csv_f)
-            
-            constraint_1 = df['Constraint 1'].unique()
-            constraint_2 = df['Constraint 2'].unique()
-            len_constraint_2 = len(constraint_2)
-            len_constraint_1 = len(constraint_1)
-            
-            if df['Errors'].max() != 0:
-                norm_errors = (df['Errors']-df['Errors'].min())/(df['Errors'].max()-df['Errors'].min())
-            else:
-                norm_errors = df['Errors']
-            norm_distance = (df['Distance']-df['Distance'].min())/(df['Distance'].max()-df['Distance'].min())
-
-            errors = np.around(np.array(norm_errors.to_list()),2).reshape((len_constraint_1, len_constraint_2))
-            distance = np.around(np.array(norm_distance.to_list()),2).reshape((len_constraint_1, len_constraint_2))
-
-            all_errors += [errors]
-            all_distance += [distance]
-        
-        errors = np.around(np.average(np.array(all_errors), axis=0), 2)
-        rdistance = np.around(np.average(np.array(all_distance), axis=0),2)
+        constraint_1, constraint_2, grids = query_parameter_grid("routing_runs", "qubo_routing_parameters",
+                                                                 problems, metrics, normalized=metrics, path=store)
+    errors = np.around(grids["errors"], 2)
+    rdistance = np.around(grids["distance"], 2)
         
     fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(10,4))
 
@@ -0,0 +1,57 @@
+import numpy as np
+
+import hashlib
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+class ClusterCostCache:
+    """
+    LRU cache of cluster costs keyed by a 64-bit fingerprint of the cluster members
+    maxsize=None keeps every entry
+    """
+    def __init__(self, maxsize=2**16):
+        self.maxsize = maxsize
+        self.costs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def fingerprint(cluster):
+        """
+        Returns a 64-bit hash of the sorted indices of the cluster
+        """
+        members = np.sort(np.asarray(cluster, dtype=np.int64))
+        return int.from_bytes(hashlib.blake2b(members.tobytes(), digest_size=8).digest(), "little")
+
+    def get(self, key):
+        """
+        Returns the cost stored for key, or None if it is not cached
+        """
+        cost = self.costs.get(key)
+        if cost is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.costs.move_to_end(key)
+        return cost
+
+    def put(self, key, cost):
+        self.costs[key] = cost
+        self.costs.move_to_end(key)
+        if self.maxsize is not None and len(self.costs) > self.maxsize:
+            self.costs.popitem(last=False)
+            self.evictions += 1
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.costs))
+
+    def clear(self):
+        self.costs.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.costs)
@@ -0,0 +1,100 @@
+import numpy as np
+
+from helpers.DistanceMatrix import DistanceMatrix, BLOCK_ROWS
+
+class ClusterCostKernel:
+    """
+    Intra-cluster distance sums and demand penalties of a clustering given as a label
+    vector (-1 marks unassigned points), for all the clusters at once
+    A DistanceMatrix is symmetric, so it is read as it is stored and D + D.T is never built
+    """
+    def __init__(self, distances, demand, capacity, demand_penalty=1, symmetric_distances=None):
+        self.distances = distances if isinstance(distances, DistanceMatrix) else np.asarray(distances)
+        self.demand = np.asarray(demand)
+        self.capacity = capacity
+        self.demand_penalty = demand_penalty
+        if symmetric_distances is None and not isinstance(distances, DistanceMatrix):
+            symmetric_distances = self.distances + self.distances.T
+        self.symmetric_distances = symmetric_distances
+        self.labels = None
+
+    def set_labels(self, labels, num_clusters):
+        """
+        Computes the distance sums of every cluster in one pass over the distance matrix
+        """
+        self.labels = np.array(labels, dtype=int)
+        self.num_clusters = num_clusters
+        assigned = np.flatnonzero(self.labels >= 0)
+        assigned_labels = self.labels[assigned]
+        one_hot = np.zeros((len(self.labels), num_clusters))
+        one_hot[assigned, assigned_labels] = 1
+        # Distances from every point to the members of each cluster, in both directions
+        if self.symmetric_distances is not None:
+            self.point_cluster_distances = self.symmetric_distances @ one_hot
+        else:
+            self.point_cluster_distances = np.empty(one_hot.shape)
+            for start in range(0, len(one_hot), BLOCK_ROWS):
+                self.point_cluster_distances[start:start+BLOCK_ROWS] = 2*(self.distances[start:start+BLOCK_ROWS] @ one_hot)
+        self.within = np.bincount(assigned_labels, weights=self.point_cluster_distances[assigned, assigned_labels],
+                                  minlength=num_clusters)/2
+        self.loads = np.bincount(assigned_labels, weights=self.demand[assigned], minlength=num_clusters)
+        self.sizes = np.bincount(assigned_labels, minlength=num_clusters)
+
+    def cluster_costs(self):
+        """
+        Returns the cost of every cluster, empty clusters cost nothing
+        """
+        penalty = np.abs(self.capacity - self.loads)*self.demand_penalty
+        return np.where(self.sizes > 0, self.within + penalty, 0)
+
+    def total_cost(self):
+        return self.cluster_costs().sum()
+
+    def compute_cluster_cost(self, within, load, size):
+        if size == 0:
+            return 0
+        return within + abs(self.capacity - load)*self.demand_penalty
+
+    def symmetric_column(self, p):
+        if self.symmetric_distances is not None:
+            return self.symmetric_distances[:, p]
+        return 2*self.distances[:, p]
+
+    def move_delta(self, p, b):
+        """
+        Returns the change in the total cost of moving point p to cluster b
+        """
+        a = self.labels[p]
+        if a == b:
+            return 0
+        diagonal = self.distances[p, p]
+        delta = 0
+        if a >= 0:
+            delta += self.compute_cluster_cost(self.within[a] - self.point_cluster_distances[p, a] + diagonal,
+                                               self.loads[a] - self.demand[p], self.sizes[a] - 1)
+            delta -= self.compute_cluster_cost(self.within[a], self.loads[a], self.sizes[a])
+        if b >= 0:
+            delta += self.compute_cluster_cost(self.within[b] + self.point_cluster_distances[p, b] + diagonal,
+                                               self.loads[b] + self.demand[p], self.sizes[b] + 1)
+            delta -= self.compute_cluster_cost(self.within[b], self.loads[b], self.sizes[b])
+        return delta
+
+    def move(self, p, b):
+        """
+        Moves point p to cluster b updating the sums in O(n)
+        """
+        a = self.labels[p]
+        if a == b:
+            return
+        diagonal = self.distances[p, p]
+        if a >= 0:
+            self.within[a] -= self.point_cluster_distances[p, a] - diagonal
+            self.loads[a] -= self.demand[p]
+            self.sizes[a] -= 1
+            self.point_cluster_distances[:, a] -= self.symmetric_column(p)
+        if b >= 0:
+            self.within[b] += self.point_cluster_distances[p, b] + diagonal
+            self.loads[b] += self.demand[p]
+            self.sizes[b] += 1
+            self.point_cluster_distances[:, b] += self.symmetric_column(p)
+        self.labels[p] = b
@@ -3,12 +3,19 @@ import matplotlib.pyplot as plt
 
 import time
 
-from helpers.utils import read_xml,get_distances_wo_depots
+import multiprocessing as mp
+
+from helpers.utils import read_xml,get_distances_wo_depots,draw_arcs
+from helpers.shared_arrays import create_shared_array, attach_shared_array, release_shared_arrays
+from helpers.DistanceMatrix import DistanceMatrix
+from hybrid.clustering.ClusterCostCache import ClusterCostCache
+from hybrid.clustering.ClusterCostKernel import ClusterCostKernel
 
 class KMedoids:
     def __init__(self,distances,num_clusters,demand, capacity, iters, demand_penalty=1,
-                 initial_medoids=None, verbose = False):
-        self.distances = np.array(distances)
+                 initial_medoids=None, verbose = False, n_jobs=1, cache_size=2**16, capacity_aware=False):
+        # A DistanceMatrix is indexed as it is stored, without a dense copy
+        self.distances = distances if isinstance(distances, DistanceMatrix) else np.asarray(distances)
         self.num_clusters = num_clusters
         self.demand = np.array(demand)
         self.capacity = capacity
@@ -20,8 +27,14 @@ class KMedoids:
         self.data = list(range(len(demand)))
         self.verbose = verbose
         self.demand_penalty = demand_penalty
+        if n_jobs == -1:
+            n_jobs = mp.cpu_count()
+        self.n_jobs = n_jobs
+        self.capacity_aware = capacity_aware
         
-        self.cluster_cost_dict = {}
+        self.cluster_cost_cache = ClusterCostCache(cache_size)
+        self.cost_kernel = None
+        self.pool = None
     
     def compute_cluster_load(self, cluster):
         return np.sum(self.demand[cluster])
@@ -32,112 +45,343 @@ class KMedoids:
         return [i for i,x in demand_tuples[:self.num_clusters]]
     
     def compute_cluster_costs(self, cluster):
-        if str(cluster) in self.cluster_cost_dict:
-            cost = self.cluster_cost_dict[str(cluster)]
-        else:
-            if len(cluster)>0:
-                cost = np.sum([self.distances[cluster*len(cluster), np.repeat(cluster, len(cluster))]])
-                cluster_demand = np.sum(self.demand[cluster])
-                cost += abs((self.capacity) - cluster_demand)*self.demand_penalty
-                self.cluster_cost_dict[str(cluster)]=cost
-            else:
-                cost = 0
+        if len(cluster)==0:
+            return 0
+        key = self.cluster_cost_cache.fingerprint(cluster)
+        cost = self.cluster_cost_cache.get(key)
+        if cost is None:
+            cost = np.sum([self.distances[cluster*len(cluster), np.repeat(cluster, len(cluster))]])
+            cluster_demand = np.sum(self.demand[cluster])
+            cost += abs((self.capacity) - cluster_demand)*self.demand_penalty
+            self.cluster_cost_cache.put(key, cost)
         return cost
+    
+    def compute_total_cost(self, clusters):
+        cost = 0
+        for cluster in clusters:
+            cost += self.compute_cluster_costs(cluster)
+        return cost
+    
+    def get_cost_kernel(self):
+        if self.cost_kernel is None:
+            self.cost_kernel = ClusterCostKernel(self.distances, self.demand, self.capacity, self.demand_penalty)
+        return self.cost_kernel
                 
     
-    def assign_datapoints(self, medoids, data):
-        tmp_clusters = [[] for _ in range(len(medoids))]
-        for d in data:
-            tmp_clusters[self.distances[d, medoids].argmin()]+=[d]
-        cst = 0
-        for i, cluster in enumerate(tmp_clusters):
-            cst += self.compute_cluster_costs(cluster)
-        return tmp_clusters, cst
-    
-    def plot_data(self, clusters, data, depot, paths=None, show_demand=False, plot_numbers=False, save_file=None):
-        colors =  np.array(np.random.randint(0, 255, size =(self.num_clusters, 4)))/255
-        colors[:,3]=1
-        markers = ["o","^","s","p","P","h","X","8","D"]
-        
-        fig, ax = plt.subplots(1,1)
-        total_demand = 0
-        for i, x in enumerate(self.medoids):
-            cluster_demand = self.compute_cluster_load(clusters[i])
-            total_demand += cluster_demand
-            if cluster_demand>self.capacity:
-                marker = "X"
-            else:
-                marker = "o"
-            #markers[i%len(markers)]
-            [plt.scatter(data[t][0], data[t][1], marker=marker, 
-                         s=50, color=colors[i]) for t in clusters[i] if t!=x]
-            plt.scatter(data[x][0], data[x][1], marker="*", s=100, color="black")
-            ax.annotate(cluster_demand, (data[x][0], data[x][1]))
-            if paths is not None:
-                for path in paths[i]:
-                    if path[0]==0:
-                        A = depot
-                    else:
-                        A = data[path[0]-1]
-                    if path[1]==0:
-                        B = depot
-                    else:
-                        B = data[path[1]-1]
-                    plt.arrow(A[0], A[1], B[0]-A[0],B[1]-A[1], head_width=1, 
-                              length_includes_head=True,color=colors[i])
+    def compute_nearest_medoids(self, medoids):
+        """
+        Returns the position (in medoids) of the nearest and second nearest medoid
+        of every datapoint, together with the distances to them
+        """
+        medoid_distances = self.distances[:, medoids]
+        rows = np.arange(len(medoid_distances))
+        nearest = medoid_distances.argmin(axis=1)
+        nearest_distance = medoid_distances[rows, nearest]
+        if len(medoids) > 1:
+            medoid_distances[rows, nearest] = np.inf
+            second = medoid_distances.argmin(axis=1)
+            second_distance = medoid_distances[rows, second]
+        else:
+            second = nearest.copy()
+            second_distance = np.full(len(rows), np.inf)
+        return nearest, nearest_distance, second, second_distance
+    
+    def compute_swap_labels(self, i, candidates, nearest, nearest_distance, second, second_distance):
+        """
+        Returns the labels of every datapoint (one row per candidate) after replacing
+        the medoid at position i with each of the candidates
+        """
+        other = np.where(nearest == i, second, nearest)
+        other_distance = np.where(nearest == i, second_distance, nearest_distance)
+        candidate_distance = self.distances[:, candidates].T
+        # argmin keeps the first medoid on ties, so position i wins only if it comes first
+        take = (candidate_distance < other_distance) | ((candidate_distance == other_distance) & (i < other))
+        return np.where(take, i, other)
+    
+    def compute_swap_costs(self, labels, swap_labels, cluster_distances):
+        """
+        Estimates the cost of every row of swap_labels from the cost delta with
+        respect to the current labels
+        """
+        num_swaps, num_points = swap_labels.shape
+        num_clusters = cluster_distances.shape[1]
+        rows = np.arange(num_points)
+        base = cluster_distances[rows, labels].sum()
+        costs = base/2 + cluster_distances[rows, swap_labels].sum(axis=1) - base
         
-        plt.scatter(depot[0], depot[1], marker="o", s=50, color='black')
+        flat_labels = (np.arange(num_swaps)[:, None]*num_clusters + swap_labels).ravel()
+        loads = np.bincount(flat_labels, weights=np.tile(self.demand, num_swaps),
+                            minlength=num_swaps*num_clusters).reshape(num_swaps, num_clusters)
+        sizes = np.bincount(flat_labels, minlength=num_swaps*num_clusters).reshape(num_swaps, num_clusters)
+        costs += (np.abs(self.capacity - loads)*(sizes > 0)).sum(axis=1)*self.demand_penalty
         
-        if show_demand:
-            for i, txt in enumerate(self.demand):
-                ax.annotate(txt, (data[i][0], data[i][1]))
-                
-        if plot_numbers:
-            for i in range(len(self.data)):
-                ax.annotate(i, (data[i][0], data[i][1]))
-                
-        if save_file:
-            if not save_file.endswith(".png"):
-                save_file += ".png"
-            plt.savefig(save_file)
+        # Correct the pairs where both points change cluster
+        for s in range(num_swaps):
+            changed = np.flatnonzero(swap_labels[s] != labels)
+            if len(changed) == 0:
+                continue
+            old = labels[changed]
+            new = swap_labels[s, changed]
+            same_old = old[:, None] == old[None, :]
+            same_new = new[:, None] == new[None, :]
+            cross = new[:, None] == old[None, :]
+            weights = same_new.astype(np.int8) + same_old - cross - cross.T
+            costs[s] += np.sum(self.distances[changed][:, changed]*weights)
+        return costs
+    
+    def evaluate_swaps(self, i, candidates, nearest_state, cluster_distances):
+        """
+        Returns the estimated cost of swapping the medoid at position i with each candidate
+        """
+        swap_labels = self.compute_swap_labels(i, candidates, *nearest_state)
+        return self.compute_swap_costs(nearest_state[0], swap_labels, cluster_distances)
+    
+    def find_swap(self, i, start, cost, nearest_state, cluster_distances):
+        """
+        Returns the first candidate (from data[start:]) whose swap with the medoid at
+        position i improves the cost, following the same order as a full sweep
+        """
+        is_medoid = np.zeros(len(self.data), dtype=bool)
+        is_medoid[self.medoids] = True
+        candidates = np.array([d for d in self.data[start:] if not is_medoid[d]], dtype=int)
+        if len(candidates) == 0:
+            return None
+        if self.pool is not None and len(candidates) >= 2*self.n_jobs:
+            # Chunks are contiguous, so the costs come back in the serial order
+            tasks = [(i, chunk) for chunk in np.array_split(candidates, self.n_jobs)]
+            costs = np.concatenate(self.pool.starmap(evaluate_swaps_worker, tasks))
         else:
-            plt.show()
-            
-        plt.close()
+            costs = self.evaluate_swaps(i, candidates, nearest_state, cluster_distances)
+        tolerance = 1e-9*max(abs(cost), 1)
+        # Estimates are only used to skip swaps, the accepted cost is always exact
+        for s in np.flatnonzero(costs < cost + tolerance):
+            swap_labels = self.compute_swap_labels(i, candidates[s:s+1], *nearest_state)[0]
+            tmp_clusters = [np.flatnonzero(swap_labels == k).tolist() for k in range(len(self.medoids))]
+            tmp_cost = self.compute_total_cost(tmp_clusters)
+            if tmp_cost < cost:
+                return int(candidates[s]), tmp_clusters, tmp_cost
+        return None
+    
+    def start_swap_pool(self):
+        """
+        Starts the worker pool used to evaluate swaps, the distances and demand are
+        shared with the workers instead of being sent with every task
+        """
+        num_points = len(self.data)
+        num_clusters = len(self.medoids)
+        # A DistanceMatrix shares its stored array and is rebuilt over it in the workers
+        distance_settings = None
+        distances = self.distances
+        if isinstance(distances, DistanceMatrix):
+            distances, distance_settings = distances.share_parts()
+        arrays = {
+            "distances": distances,
+            "demand": self.demand,
+            "nearest": np.zeros(num_points, dtype=int),
+            "nearest_distance": np.zeros(num_points),
+            "second": np.zeros(num_points, dtype=int),
+            "second_distance": np.zeros(num_points),
+            "cluster_distances": np.zeros((num_points, num_clusters)),
+        }
+        self.shared_blocks = []
+        self.shared_state = {}
+        specs = {}
+        for key, array in arrays.items():
+            block, shared, spec = create_shared_array(array)
+            self.shared_blocks += [block]
+            self.shared_state[key] = shared
+            specs[key] = spec
+        self.pool = mp.Pool(self.n_jobs, initializer=init_swap_worker,
+                            initargs=(specs, self.num_clusters, self.capacity, self.demand_penalty, distance_settings))
+    
+    def share_swap_state(self, nearest_state, cluster_distances):
+        """
+        Publishes the current assignment to the worker pool
+        """
+        for key, array in zip(["nearest", "nearest_distance", "second", "second_distance"], nearest_state):
+            self.shared_state[key][...] = array
+        self.shared_state["cluster_distances"][...] = cluster_distances
+    
+    def stop_swap_pool(self):
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        self.shared_state = None
+        release_shared_arrays(self.shared_blocks)
+        self.shared_blocks = []
+    
+    def assign_datapoints(self, medoids, data, capacity_aware=False):
+        """
+        Assigns every datapoint to its nearest medoid
+        With capacity_aware, points go to the nearest medoid whose cluster still has room
+        Returns the labels (-1 for points outside data), the members of every cluster and the cost
+        """
+        data = np.asarray(data, dtype=int)
+        medoid_distances = self.distances[np.ix_(data, medoids)]
+        if capacity_aware:
+            data_labels = self.assign_with_capacity(medoid_distances, self.demand[data])
+        else:
+            data_labels = medoid_distances.argmin(axis=1)
+        labels = np.full(len(self.distances), -1)
+        labels[data] = data_labels
+        order = np.argsort(data_labels, kind="stable")
+        bounds = np.cumsum(np.bincount(data_labels, minlength=len(medoids)))[:-1]
+        tmp_clusters = np.split(data[order], bounds)
+        kernel = self.get_cost_kernel()
+        kernel.set_labels(labels, len(medoids))
+        return labels, tmp_clusters, kernel.total_cost()
+    
+    def assign_with_capacity(self, medoid_distances, demand):
+        """
+        Greedily fills the nearest cluster with room, points that would lose the most by
+        not getting their nearest medoid are placed first
+        Points that fit nowhere go to their nearest medoid
+        """
+        preferences = np.argsort(medoid_distances, axis=1, kind="stable")
+        sorted_distances = np.take_along_axis(medoid_distances, preferences, axis=1)
+        if medoid_distances.shape[1] > 1:
+            regret = sorted_distances[:, 1] - sorted_distances[:, 0]
+        else:
+            regret = np.zeros(len(medoid_distances))
+        loads = np.zeros(medoid_distances.shape[1])
+        labels = preferences[:, 0].copy()
+        for d in np.argsort(-regret, kind="stable"):
+            fits = np.flatnonzero(loads[preferences[d]] + demand[d] <= self.capacity)
+            if len(fits) > 0:
+                labels[d] = preferences[d, fits[0]]
+            loads[labels[d]] += demand[d]
+        return labels
+    
+    def plot_data(self, clusters, data, depot, paths=None, show_demand=False, plot_numbers=False, save_file=None, renderer=None):
+        """
+        Plots the clusters and their paths, renderer: a RenderWorker that draws and saves the figure in the background
+        """
+        cluster_loads = [self.compute_cluster_load(cluster) for cluster in clusters]
+        args = (clusters, self.medoids, cluster_loads, self.capacity, data, depot, self.demand, paths,
+                show_demand, plot_numbers, save_file)
+        if renderer is not None:
+            renderer.submit(plot_clusters, *args)
+        else:
+            plot_clusters(*args)
     
     def fit(self):
         count = 0
-        clusters, cost = self.assign_datapoints(self.medoids, self.data)
+        _, clusters, _ = self.assign_datapoints(self.medoids, self.data)
+        clusters = [cluster.tolist() for cluster in clusters]
+        # Swaps are accepted comparing exact cluster costs, the kernel only gives estimates
+        cost = self.compute_total_cost(clusters)
+        kernel = self.get_cost_kernel()
+        if self.n_jobs > 1:
+            self.start_swap_pool()
         
         run = True
         
-        # TODO: ADD Parallelization
-        while run:
-            swap = False
-            for i,m in enumerate(self.medoids):
-                for d in self.data:
-                    if d not in self.medoids:
-                        tmp_medoids =  self.medoids.copy()
-                        tmp_medoids[i] = d
-                        
-                        tmp_clusters, tmp_cost = self.assign_datapoints(tmp_medoids, self.data)
-                        
-                        if tmp_cost < cost:
-                            swap = True
-                            cost = tmp_cost
-                            clusters = tmp_clusters
-                            self.medoids = tmp_medoids.copy()
-            count+=1
-            if count>=self.iters:
-                if self.verbose:
-                    print("End of the iterations.")
-                run = False
-            if not swap:
-                if self.verbose:
-                    print("No changes.")
-                run = False
+        try:
+            while run:
+                swap = False
+                # All the swaps of a medoid are evaluated at once from the nearest and second
+                # nearest medoids, restarting after every accepted swap like the full sweep did
+                for i in range(len(self.medoids)):
+                    start = 0
+                    while start < len(self.data):
+                        nearest_state = self.compute_nearest_medoids(self.medoids)
+                        kernel.set_labels(nearest_state[0], len(self.medoids))
+                        cluster_distances = kernel.point_cluster_distances
+                        if self.pool is not None:
+                            self.share_swap_state(nearest_state, cluster_distances)
+                        found = self.find_swap(i, start, cost, nearest_state, cluster_distances)
+                        if found is None:
+                            break
+                        d, clusters, cost = found
+                        swap = True
+                        self.medoids = self.medoids.copy()
+                        self.medoids[i] = d
+                        start = self.data.index(d)+1
+                count+=1
+                if count>=self.iters:
+                    if self.verbose:
+                        print("End of the iterations.")
+                    run = False
+                if not swap:
+                    if self.verbose:
+                        print("No changes.")
+                    run = False
+            if self.verbose:
+                print(self.cluster_cost_cache.cache_info())
+        finally:
+            if self.pool is not None:
+                self.stop_swap_pool()
+        if self.capacity_aware:
+            _, clusters, _ = self.assign_datapoints(self.medoids, self.data, capacity_aware=True)
+            clusters = [cluster.tolist() for cluster in clusters]
         return clusters, count
     
+
+def plot_clusters(clusters, medoids, cluster_loads, capacity, data, depot, demand, paths=None, show_demand=False,
+                  plot_numbers=False, save_file=None):
+    """
+    Draws every cluster with one scatter, the medoids with another one and all the paths with one quiver
+    """
+    num_clusters = len(medoids)
+    colors =  np.array(np.random.randint(0, 255, size =(num_clusters, 4)))/255
+    colors[:,3]=1
+    data = np.asarray(data, dtype=float)
+    
+    fig, ax = plt.subplots(1,1)
+    for i, x in enumerate(medoids):
+        marker = "X" if cluster_loads[i]>capacity else "o"
+        members = [t for t in clusters[i] if t!=x]
+        if members:
+            ax.scatter(data[members, 0], data[members, 1], marker=marker, s=50, color=colors[i])
+        ax.annotate(cluster_loads[i], (data[x][0], data[x][1]))
+    ax.scatter(data[medoids, 0], data[medoids, 1], marker="*", s=100, color="black")
+    if paths is not None:
+        draw_arcs(ax, paths[:num_clusters], data, depot, colors)
+    
+    ax.scatter(depot[0], depot[1], marker="o", s=50, color='black')
+    
+    if show_demand:
+        for i, txt in enumerate(demand):
+            ax.annotate(txt, (data[i][0], data[i][1]))
+            
+    if plot_numbers:
+        for i in range(len(demand)):
+            ax.annotate(i, (data[i][0], data[i][1]))
+            
+    if save_file:
+        if not save_file.endswith(".png"):
+            save_file += ".png"
+        plt.savefig(save_file)
+    else:
+        plt.show()
+        
+    plt.close()
+
+
+swap_worker = None
+swap_worker_blocks = []
+
+def init_swap_worker(specs, num_clusters, capacity, demand_penalty, distance_settings=None):
+    """
+    Attaches a worker process to the arrays shared by KMedoids.start_swap_pool
+    """
+    global swap_worker
+    shared = {}
+    for key, spec in specs.items():
+        block, shared[key] = attach_shared_array(spec)
+        swap_worker_blocks.append(block)
+    distances = shared["distances"]
+    if distance_settings is not None:
+        distances = DistanceMatrix.from_parts(distances, distance_settings)
+    swap_worker = KMedoids(distances, num_clusters, shared["demand"], capacity, 0,
+                           demand_penalty=demand_penalty, initial_medoids=[])
+    swap_worker.shared_state = shared
+
+def evaluate_swaps_worker(i, candidates):
+    state = swap_worker.shared_state
+    nearest_state = (state["nearest"], state["nearest_distance"], state["second"], state["second_distance"])
+    return swap_worker.evaluate_swaps(i, candidates, nearest_state, state["cluster_distances"])
+    
     
 def main():
     # Do stuff
@@ -2,11 +2,16 @@ from pyqubo import Array, Constraint, Placeholder, solve_qubo
 import neal
 from dwave_qbsolv import QBSolv
 import math
+import numpy as np
+from scipy import sparse
+
+from helpers.qubo_utils import squared_sum_penalty, coo_to_qubo_matrix, qubo_matrix_to_bqm, sampleset_to_array, \
+  pair_count, qubo_size, check_memory_budget
 
 class QUBO_Clustering:
   def __init__(self, distances, vehicle_capacity, customer_demand,
                 cost_multiplier, constraint_1_multiplier,
-                constraint_2_multiplier):
+                constraint_2_multiplier, use_pyqubo=False, memory_budget=None):
     self.num_customers = len(customer_demand)
     self.num_clusters = len(vehicle_capacity)
     self.distances = distances
@@ -16,8 +21,45 @@ class QUBO_Clustering:
     self.constraint_1_multiplier = constraint_1_multiplier
     self.constraint_2_multiplier = constraint_2_multiplier
     self.min_demand = min(customer_demand)
+    self.num_slack = math.ceil((self.vehicle_capacity[0]-1)/self.min_demand)
+    self.use_pyqubo = use_pyqubo
+    self.memory_budget = memory_budget
+    self.model = None
+    self.qubo_parts = None
+    
+  def set_multipliers(self, constraint_1_multiplier=None, constraint_2_multiplier=None):
+    """
+    Changes the constraint multipliers without rebuilding the model
+    """
+    if constraint_1_multiplier is not None:
+      self.constraint_1_multiplier = constraint_1_multiplier
+    if constraint_2_multiplier is not None:
+      self.constraint_2_multiplier = constraint_2_multiplier
+      
+  def feed_dict(self):
+    return {"constraint_1_multiplier": self.constraint_1_multiplier,
+            "constraint_2_multiplier": self.constraint_2_multiplier}
+        
+  def estimate_qubo_size(self):
+    """
+    Predicts the size of the QUBO without building it
+    The capacity constraint of each cluster covers all the cost terms of that cluster
+    """
+    n, K = self.num_customers, self.num_clusters
+    quadratic_terms = K*pair_count(n + self.num_slack) + n*pair_count(K)
+    return qubo_size(n*K + K*self.num_slack, quadratic_terms, "pyqubo" if self.use_pyqubo else "sparse")
         
   def build_qubo_model(self):
+    """
+    Compiles the PyQUBO model once, the multipliers are placeholders filled by to_qubo
+    """
+    if self.model is None:
+      self.model = self.compile_model()
+    qubo, offset = self.model.to_qubo(feed_dict=self.feed_dict())
+    return qubo, self.model
+    
+  def compile_model(self):
+    check_memory_budget(self.estimate_qubo_size(), self.memory_budget)
     
     x = Array.create("x", shape=(self.num_customers, self.num_clusters), vartype="BINARY")
     slack = Array.create("slack", shape=(self.num_clusters, math.ceil((self.vehicle_capacity[0]-1)/self.min_demand)), vartype="BINARY")
@@ -50,33 +92,141 @@ class QUBO_Clustering:
         C2 += Constraint(C2_t, label="Cluster {} exceeds vehicle capacity {}".format(k, self.vehicle_capacity[k]))
         
                 
-    H = M + C1 * self.constraint_1_multiplier + C2 * self.constraint_2_multiplier
-    model = H.compile()
+    H = M + C1 * Placeholder("constraint_1_multiplier") + C2 * Placeholder("constraint_2_multiplier")
     
-    qubo, offset = model.to_qubo()
+    return H.compile()
+  
+  def build_qubo_matrix(self):
+    """
+    Builds the same QUBO as build_qubo_model as a block structured sparse matrix
+    Variable x[i][k] has index i*num_clusters + k and slack[k][l] has index
+    num_customers*num_clusters + k*num_slack + l
+    The parts are built once, changing the multipliers only costs a matrix sum
+    Returns the matrix and the offset
+    """
+    parts = self.build_qubo_parts()
+    qubo = parts["cost"][0] + parts["constraint_1"][0]*self.constraint_1_multiplier + \
+      parts["constraint_2"][0]*self.constraint_2_multiplier
+    offset = parts["constraint_1"][1]*self.constraint_1_multiplier + parts["constraint_2"][1]*self.constraint_2_multiplier
+    return qubo, offset
+  
+  def build_qubo_parts(self):
+    """
+    Returns the (matrix, offset) of the cost and of each constraint without multipliers
+    """
+    if self.qubo_parts is not None:
+      return self.qubo_parts
+    check_memory_budget(self.estimate_qubo_size(), self.memory_budget)
+    
+    n, K = self.num_customers, self.num_clusters
+    num_x = n*K
+    num_variables = num_x + K*self.num_slack
+    x = np.arange(num_x).reshape(n, K)
+    slack = num_x + np.arange(K*self.num_slack).reshape(K, self.num_slack)
     
-    return qubo, model
+    # Main Equation: the same distance block for every cluster
+    distances = sparse.triu(np.asarray(self.distances, dtype=float)[:n, :n]*self.cost_multiplier, k=1)
+    M = sparse.kron(distances, sparse.identity(K), format="coo")
+    
+    # Each vertex must be assigned to one cluster
+    C1_rows, C1_cols, C1_values, C1_offset = squared_sum_penalty(x, 1, -1)
+    
+    # Sum of demand in each cluster must not exceed vehicle capacity
+    demand = np.asarray(self.customer_demand, dtype=float)
+    slack_weights = np.arange(1, self.num_slack+1)*self.min_demand
+    C2_indices = np.hstack([x.T, slack])
+    C2_coefficients = np.tile(np.concatenate([demand, slack_weights]), (K, 1))
+    C2_rows, C2_cols, C2_values, C2_offset = squared_sum_penalty(C2_indices, C2_coefficients, -self.vehicle_capacity[0])
+    
+    self.qubo_parts = {
+      "cost": (coo_to_qubo_matrix(M.row, M.col, M.data, num_variables), 0),
+      "constraint_1": (coo_to_qubo_matrix(C1_rows, C1_cols, C1_values, num_variables), C1_offset),
+      "constraint_2": (coo_to_qubo_matrix(C2_rows, C2_cols, C2_values, num_variables), C2_offset),
+    }
+    return self.qubo_parts
+  
+  def decode_labels(self, samples):
+    """
+    Returns the cluster of every customer (-1 if unassigned) from a sample in variable order,
+    or an array with a row of clusters for every sample of a (num_samples, num_variables) array
+    A customer assigned to several clusters keeps the last one
+    """
+    samples = np.asarray(samples)
+    x = samples[..., :self.num_customers*self.num_clusters].reshape(-1, self.num_customers, self.num_clusters)
+    last = self.num_clusters - 1 - np.argmax(x[:, :, ::-1], axis=2)
+    labels = np.where(x.any(axis=2), last, -1)
+    return labels[0].tolist() if samples.ndim == 1 else labels
   
-  def fit(self, num_reads=1000, verbose=False):
+  def repair_labels(self, labels):
+    """
+    Assigns every unassigned customer to the cluster it adds the least distance to
+    among the clusters with enough capacity left (the least loaded one if none has)
+    """
+    labels = np.array(labels)
+    distances = np.asarray(self.distances, dtype=float)[:self.num_customers, :self.num_customers]
+    demand = np.asarray(self.customer_demand)
+    assigned = labels >= 0
+    load = np.bincount(labels[assigned], weights=demand[assigned], minlength=self.num_clusters)
+    for i in np.flatnonzero(~assigned):
+      added = np.bincount(labels[assigned], weights=distances[i][assigned], minlength=self.num_clusters)
+      fits = load + demand[i] <= self.vehicle_capacity[0]
+      k = np.argmin(np.where(fits, added, np.inf)) if fits.any() else np.argmin(load)
+      labels[i] = k
+      load[k] += demand[i]
+      assigned[i] = True
+    return labels
+  
+  def best_labels(self, samples, energies):
+    """
+    Repairs every distinct sample and keeps the clustering with the least demand over the
+    capacities, then the least distance inside the clusters and then the lowest energy
+    Returns the index of the read it comes from and the clusters
+    """
+    n, K = self.num_customers, self.num_clusters
+    x, reads = np.unique(np.asarray(samples)[:, :n*K], axis=0, return_index=True)
+    labels = np.array([self.repair_labels(l) for l in self.decode_labels(x)])
+    distances = np.triu(np.asarray(self.distances, dtype=float)[:n, :n], k=1)
+    one_hot = (labels[:, :, None] == np.arange(K)).astype(float)
+    cost = np.einsum("rik,ij,rjk->r", one_hot, distances, one_hot, optimize=True)
+    load = one_hot.transpose(0, 2, 1) @ np.asarray(self.customer_demand, dtype=float)
+    overload = np.maximum(load - self.vehicle_capacity[0], 0).sum(axis=1)
+    best = np.lexsort((np.asarray(energies)[reads], cost, overload))[0]
+    return reads[best], labels[best].tolist()
+  
+  def fit(self, num_reads=1000, verbose=False, repair=True):
+    """
+    repair: every distinct read is repaired (unassigned customers get a cluster) and the best
+    feasible clustering is returned, with the energy of its read. Otherwise the lowest energy
+    read is decoded as it is
+    """
     
-    qubo_len = self.num_customers*self.num_clusters + self.num_clusters * math.ceil((self.vehicle_capacity[0]-1)/self.min_demand)
+    qubo_len = self.estimate_qubo_size().variables
     
-    qubo, model = self.build_qubo_model()
     sampler = neal.SimulatedAnnealingSampler()
-    sa_solution = sampler.sample_qubo(qubo, num_reads=num_reads)
-    agg_solution = sa_solution.aggregate()
-    raw_solution = agg_solution.first.sample
-    energy = agg_solution.first.energy
-    # decode for easier analysis
-    decoded_samples = model.decode_sample(raw_solution, vartype="BINARY")
+    if self.use_pyqubo:
+      qubo, model = self.build_qubo_model()
+      sa_solution = sampler.sample_qubo(qubo, num_reads=num_reads)
+      labels = {"x[{}][{}]".format(i, k): i*self.num_clusters + k
+                for i in range(self.num_customers) for k in range(self.num_clusters)}
+      labels.update({"slack[{}][{}]".format(k, l): qubo_len - self.num_clusters*self.num_slack + k*self.num_slack + l
+                     for k in range(self.num_clusters) for l in range(self.num_slack)})
+    else:
+      qubo, offset = self.build_qubo_matrix()
+      # The offset is left out, like when sampling the PyQUBO dictionary
+      sa_solution = sampler.sample(qubo_matrix_to_bqm(qubo), num_reads=num_reads)
+      labels = None
+    samples, energies = sampleset_to_array(sa_solution, qubo_len, labels)
+    if repair:
+      best, customer_clusters = self.best_labels(samples, energies)
+    else:
+      best = np.argmin(energies)
+      customer_clusters = self.decode_labels(samples[best])
+    energy = energies[best]
     if verbose:
       print("Energy:",energy)
-      # Show failed constraints
-      print(decoded_samples.constraints(only_broken=True))
-    # extract label
-    customer_clusters = [-1]*self.num_customers
-    for k in range(self.num_clusters):
-        for i in range(self.num_customers):
-            if decoded_samples.array("x", (i,k)) == 1:
-                customer_clusters[i] = k
-    return qubo_len,energy,customer_clusters
\ No newline at end of file
+      x = samples[best][:self.num_customers*self.num_clusters].reshape(self.num_customers, self.num_clusters)
+      for i in np.flatnonzero(x.sum(axis=1) != 1):
+        print("Customer {} not assigned to any cluster".format(i))
+      for k in np.flatnonzero(np.asarray(self.customer_demand) @ x > self.vehicle_capacity[0]):
+        print("Cluster {} exceeds vehicle capacity {}".format(k, self.vehicle_capacity[k]))
+    return qubo_len,energy,customer_clusters
@@ -1,18 +1,110 @@
 from pyqubo import Array, Constraint, Placeholder, solve_qubo
 
 import neal
+import numpy as np
+
+from helpers.qubo_utils import squared_sum_penalty, coo_to_qubo_matrix, qubo_matrix_to_bqm, sampleset_to_array, \
+    pair_count, qubo_size, check_memory_budget
+from helpers.utils import best_tsp_sample
 
 class TSP_Solver:
     
-    def __init__(self, distance_matrix, cost_multiplier=1, constraint_1_multiplier=1, constraint_2_multiplier=1):
+    def __init__(self, distance_matrix, cost_multiplier=1, constraint_1_multiplier=1, constraint_2_multiplier=1,
+                 use_pyqubo=False, memory_budget=None):
         self.num_customers = len(distance_matrix)-2
         self.all_vertices = self.num_customers+1
         self.distance_matrix = distance_matrix
         self.cost_multiplier = cost_multiplier
         self.constraint_1_multiplier = constraint_1_multiplier
         self.constraint_2_multiplier = constraint_2_multiplier
+        self.use_pyqubo = use_pyqubo
+        self.memory_budget = memory_budget
+        self.model = None
+        self.qubo_parts = None
+        
+    def set_multipliers(self, constraint_1_multiplier=None, constraint_2_multiplier=None):
+        """
+        Changes the constraint multipliers without rebuilding the model
+        """
+        if constraint_1_multiplier is not None:
+            self.constraint_1_multiplier = constraint_1_multiplier
+        if constraint_2_multiplier is not None:
+            self.constraint_2_multiplier = constraint_2_multiplier
+            
+    def feed_dict(self):
+        return {"constraint_1_multiplier": self.constraint_1_multiplier,
+                "constraint_2_multiplier": self.constraint_2_multiplier}
+        
+    def estimate_qubo_size(self):
+        """
+        Predicts the size of the QUBO without building it
+        Rows and columns of the assignment are one-hot, the cost links consecutive positions
+        """
+        n = self.all_vertices
+        quadratic_terms = 2*n*pair_count(n) + (n-1)*n*(n-1)
+        return qubo_size(n*n, quadratic_terms, "pyqubo" if self.use_pyqubo else "sparse")
+    
+    def build_qubo_parts(self):
+        """
+        Builds (once) the same QUBO as build_qubo_model as sparse matrices without multipliers
+        Variable vrp_arr[j][v] has index j*all_vertices + v
+        Returns the (matrix, offset) of the Hamiltonian cycle constraints and of the TSP cost
+        """
+        if self.qubo_parts is not None:
+            return self.qubo_parts
+        check_memory_budget(self.estimate_qubo_size(), self.memory_budget)
+        n = self.all_vertices
+        index = np.arange(n*n).reshape(n, n)
+        
+        # Every vertex only appears once, there is a jth node for each j and the cycle starts at 0
+        groups = [squared_sum_penalty(index.T, -1, 1), squared_sum_penalty(index, -1, 1),
+                  squared_sum_penalty([[index[0][0]]], -1, 1)]
+        rows = np.concatenate([g[0] for g in groups])
+        cols = np.concatenate([g[1] for g in groups])
+        values = np.concatenate([g[2] for g in groups])
+        offset = sum(g[3] for g in groups)
+        
+        # TSP: distance[u][v] between the jth and (j+1)th nodes
+        j, u, v = np.meshgrid(np.arange(n-1), np.arange(n), np.arange(n), indexing="ij")
+        arcs = u != v
+        j, u, v = j[arcs], u[arcs], v[arcs]
+        distances = np.asarray(self.distance_matrix, dtype=float)[:n, :n]
+        
+        self.qubo_parts = {
+            "constraints": (coo_to_qubo_matrix(rows, cols, values, n*n), offset),
+            "cost": (coo_to_qubo_matrix(index[j, u], index[j+1, v], distances[u, v]*self.cost_multiplier, n*n), 0),
+        }
+        return self.qubo_parts
+    
+    def build_qubo_matrix(self):
+        """
+        Combines the parts with the current multipliers
+        Returns the matrix and the offset
+        """
+        parts = self.build_qubo_parts()
+        qubo = parts["constraints"][0]*self.constraint_1_multiplier*self.constraint_1_multiplier + \
+            parts["cost"][0]*self.constraint_2_multiplier
+        offset = parts["constraints"][1]*self.constraint_1_multiplier*self.constraint_1_multiplier
+        return qubo, offset
+    
+    def build_bqm(self, include_offset=False):
+        """
+        Like sampling the PyQUBO dictionary, the offset is left out of the energies by default
+        """
+        qubo, offset = self.build_qubo_matrix()
+        return qubo_matrix_to_bqm(qubo, offset if include_offset else 0)
         
     def build_qubo_model(self):
+        """
+        Compiles the PyQUBO model once, the multipliers are placeholders filled by to_qubo
+        """
+        if self.model is None:
+            self.model = self.compile_model()
+        qubo, offset = self.model.to_qubo(feed_dict=self.feed_dict())
+        return qubo, self.model
+    
+    def compile_model(self):
+        check_memory_budget(self.estimate_qubo_size(), self.memory_budget)
     
         # Create the set of variables
         vrp_arr = Array.create("vrp_arr", shape=(self.all_vertices, self.all_vertices), vartype="BINARY")
@@ -44,7 +136,8 @@ class TSP_Solver:
         ct3_t = ct3_t ** 2
         ct3 = Constraint(ct3_t, label="The cycle must start at vertex 0")
         
-        H_A = ct1*self.constraint_1_multiplier + ct2*self.constraint_1_multiplier + ct3*self.constraint_1_multiplier
+        constraint_1_multiplier = Placeholder("constraint_1_multiplier")
+        H_A = ct1*constraint_1_multiplier + ct2*constraint_1_multiplier + ct3*constraint_1_multiplier
         
         
         # TSP 
@@ -55,19 +148,28 @@ class TSP_Solver:
                     if u!=v:
                         H_B += self.distance_matrix[u][v]*self.cost_multiplier * vrp_arr[j][u]*vrp_arr[j+1][v]
             
-        final_eq = H_A*self.constraint_1_multiplier + H_B*self.constraint_2_multiplier
+        final_eq = H_A*constraint_1_multiplier + H_B*Placeholder("constraint_2_multiplier")
         
-        model = final_eq.compile()
+        return final_eq.compile()
     
-        qubo, offset = model.to_qubo()
-        
-        return qubo, model
-    
-    def get_solution(self, num_reads=10000, verbose=False):
-        qubo, model = self.build_qubo_model()
+    def get_solution(self, num_reads=10000, verbose=False, repair=True):
+        """
+        repair: every distinct read is repaired into a tour and the shortest one is returned,
+        with the energy of its read. Otherwise the lowest energy read is returned as it is
+        """
         sampler = neal.SimulatedAnnealingSampler()
-        sa_solution = sampler.sample_qubo(qubo, num_reads=num_reads)
-        solution = sa_solution.first
-        energy = solution.energy
-            
-        return solution.sample.values(), energy
\ No newline at end of file
+        labels = None
+        if self.use_pyqubo:
+            qubo, model = self.build_qubo_model()
+            sa_solution = sampler.sample_qubo(qubo, num_reads=num_reads)
+            n = self.all_vertices
+            labels = {"vrp_arr[{}][{}]".format(j, v): j*n + v for j in range(n) for v in range(n)}
+        else:
+            sa_solution = sampler.sample(self.build_bqm(), num_reads=num_reads)
+        if not repair:
+            solution = sa_solution.first
+            return solution.sample.values(), solution.energy
+        
+        samples, energies = sampleset_to_array(sa_solution, self.all_vertices**2, labels)
+        sample, energy = best_tsp_sample(samples, energies, self.distance_matrix)
+        return sample.tolist(), energy
\ No newline at end of file
@@ -2,16 +2,44 @@ from dadk.BinPol import BitArrayShape, VarSlack, VarShapeSet, SlackType, BinPol
 import neal
 from dwave.system import DWaveSampler, EmbeddingComposite
 
+from helpers.qubo_utils import sampleset_to_array, pair_count, qubo_size, check_memory_budget
+from helpers.utils import best_tsp_sample
+
 class TSP_Solver_DADK:
     
-    def __init__(self, distance_matrix, constraint_1_multiplier=1, constraint_2_multiplier=1):
+    def __init__(self, distance_matrix, constraint_1_multiplier=1, constraint_2_multiplier=1, memory_budget=None):
         self.num_customers = len(distance_matrix)-2
         self.all_vertices = self.num_customers+1
         self.distance_matrix = distance_matrix
         self.constraint_1_multiplier = constraint_1_multiplier
         self.constraint_2_multiplier = constraint_2_multiplier
+        self.qubo_parts = None
+        self.memory_budget = memory_budget
         
-    def build_qubo(self):
+    def set_multipliers(self, constraint_1_multiplier=None, constraint_2_multiplier=None):
+        """
+        Changes the constraint multipliers without rebuilding the polynomials
+        """
+        if constraint_1_multiplier is not None:
+            self.constraint_1_multiplier = constraint_1_multiplier
+        if constraint_2_multiplier is not None:
+            self.constraint_2_multiplier = constraint_2_multiplier
+        
+    def estimate_qubo_size(self):
+        """
+        Predicts the size of the QUBO without building it
+        """
+        n = self.all_vertices
+        quadratic_terms = 2*n*pair_count(n) + (n-1)*n*(n-1)
+        return qubo_size(n*n, quadratic_terms, "dadk")
+        
+    def build_qubo_parts(self):
+        """
+        Builds (once) the constraint and TSP polynomials without multipliers
+        """
+        if self.qubo_parts is not None:
+            return self.qubo_parts
+        check_memory_budget(self.estimate_qubo_size(), self.memory_budget)
         my_bit_shape_array = BitArrayShape(name='vrp_arr', shape=(self.all_vertices, self.all_vertices),
                                        axis_names=['order', 'customer'])
         my_varshapeset = VarShapeSet(my_bit_shape_array)
@@ -43,10 +71,6 @@ class TSP_Solver_DADK:
         ct3.add_term(-1, ("vrp_arr", 0, 0))
         ct3 = ct3 ** 2
         
-        H_A = BinPol.sum(ct1*self.constraint_1_multiplier,
-                        ct2*self.constraint_1_multiplier,
-                        ct3*self.constraint_1_multiplier)
-        
         # TSP 
         H_B = BinPol(my_varshapeset)
         for u in range(self.all_vertices):
@@ -54,6 +78,16 @@ class TSP_Solver_DADK:
                 for j in range(self.all_vertices-1):
                     if u!=v:
                         H_B.add_term(self.distance_matrix[u][v],("vrp_arr",j,u),("vrp_arr",j+1,v))
+        
+        self.qubo_parts = (ct1, ct2, ct3, H_B)
+        return self.qubo_parts
+    
+    def build_qubo(self):
+        ct1, ct2, ct3, H_B = self.build_qubo_parts()
+        
+        H_A = BinPol.sum(ct1*self.constraint_1_multiplier,
+                        ct2*self.constraint_1_multiplier,
+                        ct3*self.constraint_1_multiplier)
             
         final_eq = BinPol.sum(H_A*self.constraint_1_multiplier, H_B*self.constraint_2_multiplier)
 
@@ -62,12 +96,19 @@ class TSP_Solver_DADK:
     def get_bqm(self):
         return self.build_qubo().as_bqm()
     
-    def get_solution(self, num_reads=10000, label=None):
+    def get_solution(self, num_reads=10000, label=None, repair=True):
+        """
+        repair: like TSP_Solver.get_solution, returns the shortest repaired tour of all the reads
+        """
         bqm = self.get_bqm()
     
         sa = neal.SimulatedAnnealingSampler()
         
         sampleset = sa.sample(bqm, num_reads=num_reads, label=label)
-        solution = sampleset.first
+        if not repair:
+            solution = sampleset.first
+            return solution.sample.values(), solution.energy
         
-        return solution.sample.values(), solution.energy
\ No newline at end of file
+        samples, energies = sampleset_to_array(sampleset, self.all_vertices**2)
+        sample, energy = best_tsp_sample(samples, energies, self.distance_matrix)
+        return sample.tolist(), energy
\ No newline at end of file
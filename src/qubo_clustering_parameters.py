@@ -1,19 +1,25 @@
 from hybrid.clustering.QUBO_Clustering import QUBO_Clustering
 
 from helpers.utils import read_xml, plot_data, count_clusters_with_more_demand
+from helpers.batch_runner import get_instances
+from helpers.WorkerPool import WorkerPool, load_instance, instance_key
+from helpers.RenderWorker import RenderWorker
+from helpers.result_store import append_rows, new_run
 
 from sklearn.metrics import silhouette_score
 
 import time
+import sys
 
-import multiprocessing as mp
+# Multiplier grid of the parameter sweep, python qubo_clustering_parameters.py sweep
+constraint_1_multipliers = [1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000]
+constraint_2_multipliers = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
 
-import csv
 
-def run_qubo_solver(distances, vehicle_capacity, customer_demand, num_reads, constraint_1_multiplier, constraint_2_multiplier):
+def run_qubo_solver(instance, vehicle_capacity, customer_demand, num_reads, constraint_1_multiplier, constraint_2_multiplier):
   qstart = time.time()
   
-  qubo_clustering = QUBO_Clustering(distances, vehicle_capacity, customer_demand, cost_multiplier=200,
+  qubo_clustering = QUBO_Clustering(load_instance(instance)["distances"], vehicle_capacity, customer_demand, cost_multiplier=200,
                                   constraint_1_multiplier=constraint_1_multiplier, constraint_2_multiplier=constraint_2_multiplier)
   
   qubo_len, q_energy, q_clusters = qubo_clustering.fit(num_reads=num_reads)
@@ -22,15 +28,59 @@ def run_qubo_solver(distances, vehicle_capacity, customer_demand, num_reads, con
   
   return num_reads, qubo_len, q_energy, q_clusters, qend-qstart
 
-def run_qubo_clustering(problem):
-    problem_name = problem.split(".xml")[0]
+# QUBO_Clustering of the instance each worker is sweeping, the pool is shared by every problem
+sweep_models = {}
+
+def get_sweep_model(instance, vehicle_capacity, customer_demand, constraint_1_multiplier, constraint_2_multiplier):
+  key = instance_key(instance)
+  if key not in sweep_models:
+    sweep_models.clear()
+    qubo_clustering = QUBO_Clustering(load_instance(instance)["distances"], vehicle_capacity, customer_demand, cost_multiplier=200,
+                                  constraint_1_multiplier=constraint_1_multiplier, constraint_2_multiplier=constraint_2_multiplier)
+    qubo_clustering.build_qubo_parts()
+    sweep_models[key] = qubo_clustering
+  return sweep_models[key]
+  
+def run_qubo_sweep_solver(instance, vehicle_capacity, customer_demand, num_reads, constraint_1_multiplier, constraint_2_multiplier):
+  # The QUBO parts are built once per worker and instance, each grid cell only sums them with new multipliers
+  # Reads are not repaired, the sweep measures how often the QUBO itself is feasible
+  qstart = time.time()
+  
+  qubo_clustering = get_sweep_model(instance, vehicle_capacity, customer_demand, constraint_1_multiplier, constraint_2_multiplier)
+  qubo_clustering.set_multipliers(constraint_1_multiplier, constraint_2_multiplier)
+  qubo_len, q_energy, q_clusters = qubo_clustering.fit(num_reads=num_reads, repair=False)
+  
+  qend = time.time()
+  
+  return constraint_1_multiplier, constraint_2_multiplier, qubo_len, q_energy, q_clusters, qend-qstart
 
-    csv_file_name = problem_name+'_Parameters.csv'    
-    f = open('./results/qubo_clustering_num_reads/'+csv_file_name, 'w')
-    writer = csv.writer(f)
+def run_qubo_parameter_sweep(problem, pool, constraint_1_multipliers, constraint_2_multipliers, num_reads=1000):
+    customer_demand, vehicle_capacity, distances, customer_locations, depot = read_xml(
+            './data/'+problem,0, False, False)
     
-    headers = "Problem,Nodes,Clusters,Algorithm,Solver,Num Reads/Iters,Time,Unassigned Nodes,Demand Errors,Silhouette,QUBO length,Energy,Constraint 1,Constraint 2".split(",")
-    writer.writerow(headers)
+    run = new_run()
+    rows = []
+    instance = pool.share_instance(problem, distances=distances)
+    result_objects = [pool.apply_async(run_qubo_sweep_solver, args=(instance, vehicle_capacity, customer_demand, num_reads, constraint_1_multiplier, constraint_2_multiplier)) 
+                    for constraint_1_multiplier in constraint_1_multipliers for constraint_2_multiplier in constraint_2_multipliers]
+    for r in result_objects:
+        constraint_1_multiplier, constraint_2_multiplier, qubo_len, q_energy, q_clusters, q_time = r.get()
+        silhouette_score_qubo = silhouette_score(customer_locations, q_clusters)
+        
+        q_unassigned_nodes = q_clusters.count(-1)
+        q_demand_errors = count_clusters_with_more_demand(q_clusters, len(vehicle_capacity), vehicle_capacity[0], customer_demand)
+        
+        rows += [{"run": run, "experiment": "qubo_clustering_parameters", "problem": problem, "nodes": len(customer_demand),
+                  "clusters": len(vehicle_capacity), "algorithm": "QUBO", "solver": "SimulatedAnnealingSampler",
+                  "num_reads": num_reads, "clustering_time": q_time, "unassigned_nodes": q_unassigned_nodes,
+                  "demand_errors": q_demand_errors, "silhouette": silhouette_score_qubo, "qubo_length": qubo_len,
+                  "energy": q_energy, "constraint_1": constraint_1_multiplier, "constraint_2": constraint_2_multiplier}]
+    pool.release_instance(problem)
+    # One transaction per sweep, so the heatmaps never read a partial run
+    append_rows("clustering_runs", rows)
+
+def run_qubo_clustering(problem, pool, renderer=None):
+    problem_name = problem.split(".xml")[0]
     
     customer_demand, vehicle_capacity, distances, customer_locations, depot = read_xml(
             './data/'+problem,0, False, False)
@@ -39,8 +89,9 @@ def run_qubo_clustering(problem):
     constraint_1_multiplier = 50000
     constraint_2_multiplier = 20
       
-    pool = mp.Pool(mp.cpu_count())
-    result_objects = [pool.apply_async(run_qubo_solver, args=(distances, vehicle_capacity, customer_demand, num_reads, constraint_1_multiplier, constraint_2_multiplier)) 
+    run = new_run()
+    instance = pool.share_instance(problem, distances=distances)
+    result_objects = [pool.apply_async(run_qubo_solver, args=(instance, vehicle_capacity, customer_demand, num_reads, constraint_1_multiplier, constraint_2_multiplier)) 
                     for num_reads in [10,100,500,1000,2000,5000,10000]]
     for i,r in enumerate(result_objects):
         num_reads = r.get()[0]
@@ -55,64 +106,41 @@ def run_qubo_clustering(problem):
         q_demand_errors = count_clusters_with_more_demand(q_clusters, len(vehicle_capacity), vehicle_capacity[0], customer_demand)
         
         plot_data(q_clusters, len(vehicle_capacity), vehicle_capacity[0], customer_locations, depot,
-            customer_demand, show_demand=False, show_cluster_demand=True, save_file=save_file)
+            customer_demand, show_demand=False, show_cluster_demand=True, save_file=save_file, renderer=renderer)
         
-        writer.writerow("{},{},{},{},{},{},{:.2f},{},{},{:.20f},{},{},{},{}".format(problem,len(customer_demand), len(vehicle_capacity), "QUBO", "SimulatedAnnealingSampler",
-                                                                num_reads,q_time, q_unassigned_nodes, q_demand_errors, silhouette_score_qubo, qubo_len,
-                                                                q_energy, constraint_1_multiplier, constraint_2_multiplier).split(","))
-    pool.close()
-    pool.join()
-    f.close()
+        append_rows("clustering_runs", [{"run": run, "experiment": "qubo_clustering_num_reads", "problem": problem, "nodes": len(customer_demand),
+                                         "clusters": len(vehicle_capacity), "algorithm": "QUBO", "solver": "SimulatedAnnealingSampler",
+                                         "num_reads": num_reads, "clustering_time": q_time, "unassigned_nodes": q_unassigned_nodes,
+                                         "demand_errors": q_demand_errors, "silhouette": silhouette_score_qubo, "qubo_length": qubo_len,
+                                         "energy": q_energy, "constraint_1": constraint_1_multiplier, "constraint_2": constraint_2_multiplier}])
+    pool.release_instance(problem)
       
       
 
 def main():
     # Do stuff
+    # python qubo_clustering_parameters.py sweep runs the multiplier grid for the clustering heatmaps
+    sweep = len(sys.argv)>1 and sys.argv[1]=='sweep'
     #files = (get_files_in_folder('./data/'))
     #files.sort()
     #files =['CMT01.xml','M-n101-k10.xml','M-n121-k07.xml','M-n151-k12.xml','M-n200-k16.xml','M-n200-k17.xml']
-    files = ['CMT01.xml','CMT02.xml','CMT03.xml','CMT04.xml','CMT05.xml','CMT06.xml','CMT07.xml','CMT08.xml',
-                    'CMT09.xml','CMT10.xml','CMT11.xml','CMT12.xml','CMT13.xml','CMT14.xml',
-                    'M-n101-k10.xml','M-n121-k07.xml','M-n151-k12.xml','M-n200-k16.xml','M-n200-k17.xml',
-                    'Golden_01.xml','Golden_02.xml','Golden_03.xml','Golden_04.xml','Golden_05.xml','Golden_06.xml',
-                    'Golden_07.xml','Golden_08.xml','Golden_09.xml','Golden_10.xml','Golden_11.xml','Golden_12.xml',
-                    'Golden_13.xml','Golden_14.xml','Golden_15.xml','Golden_16.xml','Golden_17.xml','Golden_18.xml',
-                    'Golden_19.xml','Golden_20.xml',
-                    'Li_21.xml','Li_22.xml','Li_23.xml','Li_24.xml','Li_25.xml','Li_26.xml','Li_27.xml','Li_28.xml',
-                    'Li_29.xml','Li_30.xml','Li_31.xml','Li_32.xml',
-                    'X-n101-k25.xml']
+    files = get_instances(["CMT", "M", "Golden", "Li", "X-n101-k25.xml"])
     
-    X_files = ['X-n101-k25.xml','X-n106-k14.xml','X-n110-k13.xml','X-n115-k10.xml',
-            'X-n120-k6.xml','X-n125-k30.xml','X-n129-k18.xml','X-n134-k13.xml',
-            'X-n139-k10.xml','X-n143-k7.xml','X-n148-k46.xml','X-n153-k22.xml',
-            'X-n157-k13.xml','X-n162-k11.xml','X-n167-k10.xml','X-n172-k51.xml',
-            'X-n176-k26.xml','X-n181-k23.xml','X-n186-k15.xml','X-n190-k8.xml',
-            'X-n195-k51.xml','X-n200-k36.xml','X-n204-k19.xml','X-n209-k16.xml',
-            'X-n214-k11.xml','X-n219-k73.xml','X-n223-k34.xml','X-n228-k23.xml',
-            'X-n233-k16.xml','X-n237-k14.xml','X-n242-k48.xml','X-n247-k47.xml',
-            'X-n251-k28.xml','X-n256-k16.xml','X-n261-k13.xml','X-n266-k58.xml',
-            'X-n270-k35.xml','X-n275-k28.xml','X-n280-k17.xml','X-n284-k15.xml',
-            'X-n289-k60.xml','X-n294-k50.xml','X-n298-k31.xml','X-n303-k21.xml',
-            'X-n308-k13.xml','X-n313-k71.xml','X-n317-k53.xml','X-n322-k28.xml',
-            'X-n327-k20.xml','X-n331-k15.xml','X-n336-k84.xml','X-n344-k43.xml',
-            'X-n351-k40.xml','X-n359-k29.xml','X-n367-k17.xml','X-n376-k94.xml',
-            'X-n384-k52.xml','X-n393-k38.xml','X-n401-k29.xml','X-n411-k19.xml',
-            'X-n420-k130.xml','X-n429-k61.xml','X-n439-k37.xml','X-n449-k29.xml',
-            'X-n459-k26.xml','X-n469-k138.xml','X-n480-k70.xml','X-n491-k59.xml',
-            'X-n502-k39.xml','X-n513-k21.xml','X-n524-k137.xml','X-n536-k96.xml',
-            'X-n548-k50.xml','X-n561-k42.xml','X-n573-k30.xml','X-n586-k159.xml',
-            'X-n599-k92.xml','X-n613-k62.xml','X-n627-k43.xml','X-n641-k35.xml',
-            'X-n655-k131.xml','X-n670-k126.xml','X-n685-k75.xml','X-n701-k44.xml',
-            'X-n716-k35.xml','X-n733-k159.xml','X-n749-k98.xml','X-n766-k71.xml',
-            'X-n783-k48.xml','X-n801-k40.xml','X-n819-k171.xml','X-n837-k142.xml',
-            'X-n856-k95.xml','X-n876-k59.xml','X-n895-k37.xml','X-n916-k207.xml',
-            'X-n936-k151.xml','X-n957-k87.xml','X-n979-k58.xml','X-n1001-k43.xml']
+    X_files = get_instances(["X"])
     
     problems = ['CMT06.xml','CMT03.xml','CMT01.xml','CMT02.xml','CMT11.xml','CMT12.xml','M-n101-k10.xml','M-n121-k07.xml','X-n106-k14.xml','X-n110-k13.xml','X-n120-k6.xml']
+    # One pool for every problem of the run, figures are drawn in the background
+    renderer = RenderWorker()
+    pool = WorkerPool()
     for problem in problems[:1]:
       print(problem)
-      run_qubo_clustering(problem)
+      if sweep:
+        run_qubo_parameter_sweep(problem, pool, constraint_1_multipliers, constraint_2_multipliers)
+      else:
+        run_qubo_clustering(problem, pool, renderer)
       print("done")
+    pool.close()
+    renderer.close()
       
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,21 +1,27 @@
 from hybrid.routing.TSP_Solver_DADK import TSP_Solver_DADK
 from hybrid.clustering.KMedoids import KMedoids
 
-from helpers.utils import read_xml, compute_cluster_distances, process_tsp_solution, get_distances_wo_depots, calculate_total_distance
-from helpers.check_solution import check_solution
+from helpers.utils import read_xml, get_cluster_distances, process_tsp_solution, get_distances_wo_depots, calculate_total_distance
+from helpers.check_solution import check_solutions
+from helpers.RouteTotals import RouteTotals
+from helpers.WorkerPool import WorkerPool, load_instance
+from helpers.RenderWorker import RenderWorker
+from helpers.result_store import append_rows, new_run
 
 from sklearn.metrics import silhouette_score
 
 import time
+import sys
 
-import multiprocessing as mp
+# Multiplier grid of the parameter sweep, python qubo_routing_parameters.py sweep
+constraint_1_multipliers = [10, 25, 50, 100, 150, 200, 300, 500, 700, 1000]
+constraint_2_multipliers = [10, 25, 50, 100, 150, 200, 300, 500, 700, 1000]
 
-import csv
 
-def run_dadk_solver(cluster, customer_locations, constraint_1_multiplier, constraint_2_multiplier, num_reads):
+def run_dadk_solver(cluster, instance, constraint_1_multiplier, constraint_2_multiplier, num_reads):
 
     num_customers = len(cluster)
-    cluster_distances = compute_cluster_distances(customer_locations, cluster)
+    cluster_distances = get_cluster_distances(load_instance(instance)["distances"], cluster)
 
     solver = TSP_Solver_DADK(cluster_distances, constraint_1_multiplier=constraint_1_multiplier, constraint_2_multiplier=constraint_2_multiplier)
 
@@ -25,32 +31,77 @@ def run_dadk_solver(cluster, customer_locations, constraint_1_multiplier, constr
     
     return raw_solution, solution_processed, energy
   
-def run_quantum_solvers(clusters, customer_locations, constraint_1_multiplier, constraint_2_multiplier, num_reads):
+def run_quantum_solvers(clusters, instance, pool, totals, constraint_1_multiplier, constraint_2_multiplier, num_reads):
     # Run TSP QUBO solvers for each cluster
-    solutions = []
-    raw_solutions = []
-    total_energy = 0
-    pool = mp.Pool(mp.cpu_count())
-    result_objects = [pool.apply_async(run_dadk_solver, args=(cluster, customer_locations, constraint_1_multiplier, constraint_2_multiplier, num_reads)) 
-                    for cluster in clusters]
-    for i,r in enumerate(result_objects):
-        raw_solutions += [r.get()[0]]
-        solutions += [r.get()[1]]
-        total_energy += r.get()[2]
-    pool.close()
-    pool.join()
+    # Largest clusters first, every route is added to the totals as soon as it is solved
+    tasks = [(cluster, instance, constraint_1_multiplier, constraint_2_multiplier, num_reads) for cluster in clusters]
+    for k, (raw_solution, solution, energy) in pool.as_completed(run_dadk_solver, tasks, sizes=[len(cluster) for cluster in clusters]):
+        totals.add(k, solution, energy)
     
-    return solutions, total_energy
+    return totals
 
-def run_qubo_routing(problem):
-    problem_name = problem.split(".xml")[0]
+def run_dadk_sweep(cluster, instance, constraint_multipliers, num_reads):
+    # Build the cluster QUBO once and only recombine its parts for every grid cell
+    num_customers = len(cluster)
+    cluster_distances = get_cluster_distances(load_instance(instance)["distances"], cluster)
+
+    solver = TSP_Solver_DADK(cluster_distances)
+    
+    results = []
+    for constraint_1_multiplier, constraint_2_multiplier in constraint_multipliers:
+        start = time.time()
+        solver.set_multipliers(constraint_1_multiplier, constraint_2_multiplier)
+        # Not repaired, the sweep measures how often the QUBO itself is feasible
+        solution, energy = solver.get_solution(num_reads=num_reads, repair=False)
+        raw_solution, solution_processed = process_tsp_solution(solution, num_customers, cluster)
+        results += [(solution_processed, energy, time.time()-start)]
+    
+    return results
 
-    csv_file_name = problem_name+'_Parameters.csv'    
-    f = open('./results/qubo_routing_num_reads/'+csv_file_name, 'w')
-    writer = csv.writer(f)
+def run_qubo_parameter_sweep(problem, pool, constraint_1_multipliers, constraint_2_multipliers, num_reads=10000):
+    customer_demand, vehicle_capacity, distances, customer_locations, depot = read_xml(
+            './data/'+problem,0, True, True)
+    
+    if problem == "CMT01.xml":
+        demand_penalty = 1
+    else:
+        demand_penalty = 10000
+        
+    distances_wo_depots = get_distances_wo_depots(distances)
+    clustering_start = time.time()
+    kmedoids = KMedoids(distances_wo_depots, len(vehicle_capacity), customer_demand, vehicle_capacity[0], iters=200,
+                            demand_penalty=demand_penalty, verbose=False)
+    clusters, _ = kmedoids.fit()
+    clustering_time = time.time()-clustering_start
     
-    headers = "Problem,Nodes,Vehicles,Algorithm,Solver,Num Reads/Iters,Time,Errors,Distance,Energy,Constraint 1,Constraint 2".split(",")
-    writer.writerow(headers)
+    constraint_multipliers = [(constraint_1_multiplier, constraint_2_multiplier)
+                              for constraint_1_multiplier in constraint_1_multipliers
+                              for constraint_2_multiplier in constraint_2_multipliers]
+    
+    # Every cluster runs the whole grid in one task, the time of a cell is the sum of its solves over the clusters
+    instance = pool.share_instance(problem, distances=distances)
+    result_objects = [pool.apply_async(run_dadk_sweep, args=(cluster, instance, constraint_multipliers, num_reads)) 
+                    for cluster in clusters]
+    cluster_results = [r.get() for r in result_objects]
+    pool.release_instance(problem)
+    
+    sweep_solutions = [[results[i][0] for results in cluster_results] for i in range(len(constraint_multipliers))]
+    sweep_errors = sum(check_solutions(sweep_solutions, 0, 0, customer_demand, vehicle_capacity, check_capacity=False).values())
+    run = new_run()
+    rows = []
+    for i, (constraint_1_multiplier, constraint_2_multiplier) in enumerate(constraint_multipliers):
+        solutions = sweep_solutions[i]
+        rows += [{"run": run, "experiment": "qubo_routing_parameters", "problem": problem, "nodes": len(customer_demand),
+                  "vehicles": len(vehicle_capacity), "algorithm": "QUBO", "solver": "SimulatedAnnealingSampler",
+                  "num_reads": num_reads, "clustering_time": clustering_time, "routing_time": sum(results[i][2] for results in cluster_results),
+                  "errors": sweep_errors[i], "distance": calculate_total_distance(solutions, distances),
+                  "energy": sum(results[i][1] for results in cluster_results),
+                  "constraint_1": constraint_1_multiplier, "constraint_2": constraint_2_multiplier}]
+    # One transaction per sweep, so the heatmaps never read a partial run
+    append_rows("routing_runs", rows)
+
+def run_qubo_routing(problem, pool, renderer=None):
+    problem_name = problem.split(".xml")[0]
     
     customer_demand, vehicle_capacity, distances, customer_locations, depot = read_xml(
             './data/'+problem,0, True, True)
@@ -63,42 +114,61 @@ def run_qubo_routing(problem):
         
     iters = 200
     distances_wo_depots = get_distances_wo_depots(distances)
+    clustering_start = time.time()
     kmedoids = KMedoids(distances_wo_depots, len(vehicle_capacity), customer_demand, vehicle_capacity[0], iters=iters,
                             demand_penalty=demand_penalty, verbose=False)
     clusters, _ = kmedoids.fit()
+    clustering_time = time.time()-clustering_start
     
     num_reads = 10000
     constraint_1_multiplier = 150
     constraint_2_multiplier = 700
       
+    run = new_run()
+    instance = pool.share_instance(problem, distances=distances)
     for num_reads in [10,100,1000,10000,20000,50000,100000]:
       start = time.time()
-      solutions, total_energy = run_quantum_solvers(clusters, customer_locations, constraint_1_multiplier, constraint_2_multiplier, num_reads)
+      totals = RouteTotals(distances, customer_demand, vehicle_capacity, check_capacity=False)
+      run_quantum_solvers(clusters, instance, pool, totals, constraint_1_multiplier, constraint_2_multiplier, num_reads)
       end = time.time()
-      total_distance = calculate_total_distance(solutions, distances)
-      errors = check_solution(solutions, 0, 0, customer_demand, vehicle_capacity, check_capacity=False, verbose = False)
+      solutions, total_energy = totals.solution(), totals.total_energy
+      total_distance = totals.total_distance
+      errors = totals.errors()
 
       save_file = "./results/qubo_routing_num_reads/{}/{}_nr({}).png".format(problem_name,problem_name, num_reads)
-      kmedoids.plot_data(clusters, customer_locations[1:], depot, solutions, save_file=save_file)
+      kmedoids.plot_data(clusters, customer_locations[1:], depot, solutions, save_file=save_file, renderer=renderer)
       
-      writer.writerow("{},{},{},{},{},{},{:.2f},{},{:.5f},{:.5f},{},{}".format(problem,len(customer_demand), len(vehicle_capacity), "QUBO", "SimulatedAnnealingSampler",
-                                                              num_reads,end-start, errors, total_distance, total_energy,
-                                                              constraint_1_multiplier, constraint_2_multiplier).split(","))
-    f.close()
+      append_rows("routing_runs", [{"run": run, "experiment": "qubo_routing_num_reads", "problem": problem, "nodes": len(customer_demand),
+                                    "vehicles": len(vehicle_capacity), "algorithm": "QUBO", "solver": "SimulatedAnnealingSampler",
+                                    "num_reads": num_reads, "clustering_time": clustering_time, "routing_time": end-start,
+                                    "errors": errors, "distance": total_distance, "energy": total_energy,
+                                    "constraint_1": constraint_1_multiplier, "constraint_2": constraint_2_multiplier}])
+    pool.release_instance(problem)
       
       
 
 def main():
     # Do stuff
+    # python qubo_routing_parameters.py sweep runs the multiplier grid for the heatmaps of plot_parameter_heatmaps.py
+    sweep = len(sys.argv)>1 and sys.argv[1]=='sweep'
     
     problems = ['CMT01.xml','CMT02.xml','CMT03.xml','CMT04.xml','CMT06.xml','CMT11.xml','CMT12.xml',
                 'M-n101-k10.xml','M-n121-k07.xml',
                 'X-n106-k14.xml','X-n110-k13.xml','X-n120-k6.xml','Golden_05.xml','M-n151-k12.xml']
-    problems = ['CMT07.xml','CMT08.xml','CMT09.xml','CMT13.xml','CMT14.xml','CMT05.xml','CMT10.xml']
+    if not sweep:
+      problems = ['CMT07.xml','CMT08.xml','CMT09.xml','CMT13.xml','CMT14.xml','CMT05.xml','CMT10.xml']
+    # One pool for every problem of the run, figures are drawn in the background
+    renderer = RenderWorker()
+    pool = WorkerPool()
     for problem in problems:
       print(problem)
-      run_qubo_routing(problem)
+      if sweep:
+        run_qubo_parameter_sweep(problem, pool, constraint_1_multipliers, constraint_2_multipliers)
+      else:
+        run_qubo_routing(problem, pool, renderer)
       print("done")
+    pool.close()
+    renderer.close()
       
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,110 @@
+from hybrid.clustering.KMedoids import KMedoids
+from hybrid.clustering.QUBO_Clustering import QUBO_Clustering
+from hybrid.routing.TSP_Solver import TSP_Solver
+from solver.Google_OR_Solver import solve_tsp, TimeBudget
+
+from helpers.utils import read_xml, get_distances_wo_depots, get_cluster_distances, get_tsp_cluster_distances, process_tsp_solution, count_clusters_with_more_demand, calculate_clusterability
+from helpers.RouteTotals import RouteTotals
+from helpers.WorkerPool import WorkerPool
+from helpers.batch_runner import load_manifest, run_batch, BENCHMARKS_DIR
+
+from sklearn.metrics import silhouette_score
+
+from os.path import basename, join
+
+import json
+import sys
+
+# Every algorithm runs one instance in one worker, the batch is what runs in parallel
+def get_demand_penalty(path, demand_penalty):
+    if demand_penalty is not None:
+        return demand_penalty
+    return 1 if basename(path) == "CMT01.xml" else 10000
+
+# precision, condensed and lazy select the storage of the distances, see DistanceMatrix
+def fit_kmedoids(path, iters, demand_penalty, precision="float64", condensed=False, lazy=False):
+    customer_demand, vehicle_capacity, distances, customer_locations, depot = read_xml(path, 0, True, True, precision=precision,
+                                                                                       condensed=condensed, lazy=lazy)
+    kmedoids = KMedoids(get_distances_wo_depots(distances), len(vehicle_capacity), customer_demand, vehicle_capacity[0], iters=iters,
+                        demand_penalty=get_demand_penalty(path, demand_penalty), verbose=False)
+    clusters, iter_count = kmedoids.fit()
+    return customer_demand, vehicle_capacity, distances, customer_locations, clusters, iter_count
+
+def kmedoids_clustering(path, iters=200, demand_penalty=None, precision="float64", condensed=False, lazy=False):
+    customer_demand, vehicle_capacity, distances, customer_locations, clusters, iter_count = fit_kmedoids(path, iters, demand_penalty,
+                                                                                                         precision, condensed, lazy)
+    labels = [-1]*len(customer_demand)
+    for i,cluster in enumerate(clusters):
+        for x in cluster:
+            labels[x] = i
+    return {"nodes": len(customer_demand), "clusters": len(vehicle_capacity), "iters": iter_count,
+            "unassigned_nodes": labels.count(-1),
+            "demand_errors": count_clusters_with_more_demand(labels, len(vehicle_capacity), vehicle_capacity[0], customer_demand),
+            "silhouette": float(silhouette_score(customer_locations[1:-1], labels))}
+
+def qubo_clustering(path, num_reads=5000, cost_multiplier=200, constraint_1_multiplier=50000, constraint_2_multiplier=20):
+    customer_demand, vehicle_capacity, distances, customer_locations, depot = read_xml(path, 0, False, False)
+    qubo_clustering = QUBO_Clustering(distances, vehicle_capacity, customer_demand, cost_multiplier=cost_multiplier,
+                                      constraint_1_multiplier=constraint_1_multiplier, constraint_2_multiplier=constraint_2_multiplier)
+    qubo_len, energy, labels = qubo_clustering.fit(num_reads=num_reads)
+    return {"nodes": len(customer_demand), "clusters": len(vehicle_capacity), "qubo_length": int(qubo_len), "energy": float(energy),
+            "unassigned_nodes": labels.count(-1),
+            "demand_errors": count_clusters_with_more_demand(labels, len(vehicle_capacity), vehicle_capacity[0], customer_demand),
+            "silhouette": float(silhouette_score(customer_locations, labels))}
+
+def clusterability(path):
+    _, _, _, customer_locations, _ = read_xml(path, 0, False, False)
+    dip, pval = calculate_clusterability(customer_locations, plot=False)
+    return {"dip": float(dip), "dip_p_value": float(pval)}
+
+def or_routing(path, iters=200, demand_penalty=None, time_budget=60, precision="float64", condensed=False, lazy=False):
+    customer_demand, vehicle_capacity, distances, customer_locations, clusters, iter_count = fit_kmedoids(path, iters, demand_penalty,
+                                                                                                         precision, condensed, lazy)
+    totals = RouteTotals(distances, customer_demand, vehicle_capacity)
+    budget = TimeBudget(time_budget)
+    for k, cluster in enumerate(clusters):
+        # Cluster nodes are [depot] + cluster, the depot is 0 in the whole problem too
+        nodes = [0] + [customer+1 for customer in cluster]
+        solution = solve_tsp(get_tsp_cluster_distances(distances, cluster), 0, time_budget=budget)
+        totals.add(k, [(nodes[i], nodes[j]) for i, j in solution[0]])
+    return {"nodes": len(customer_demand), "vehicles": len(vehicle_capacity), "errors": totals.errors(),
+            "distance": float(totals.total_distance)}
+
+def qubo_routing(path, iters=200, demand_penalty=None, num_reads=10000, cost_multiplier=100,
+                 constraint_1_multiplier=100, constraint_2_multiplier=5, precision="float64", condensed=False, lazy=False):
+    customer_demand, vehicle_capacity, distances, customer_locations, clusters, iter_count = fit_kmedoids(path, iters, demand_penalty,
+                                                                                                         precision, condensed, lazy)
+    totals = RouteTotals(distances, customer_demand, vehicle_capacity)
+    for k, cluster in enumerate(clusters):
+        solver = TSP_Solver(get_cluster_distances(distances, cluster), cost_multiplier=cost_multiplier,
+                            constraint_1_multiplier=constraint_1_multiplier, constraint_2_multiplier=constraint_2_multiplier)
+        solution, energy = solver.get_solution(num_reads=num_reads)
+        raw_solution, solution_processed = process_tsp_solution(solution, len(cluster), cluster)
+        totals.add(k, solution_processed, energy)
+    return {"nodes": len(customer_demand), "vehicles": len(vehicle_capacity), "errors": totals.errors(),
+            "distance": float(totals.total_distance), "energy": float(totals.total_energy)}
+
+ALGORITHMS = {"kmedoids_clustering": kmedoids_clustering, "qubo_clustering": qubo_clustering,
+              "clusterability": clusterability, "or_routing": or_routing, "qubo_routing": qubo_routing}
+# Power of the number of nodes the time of each algorithm grows with, to schedule the longest jobs first
+COST_EXPONENTS = {"kmedoids_clustering": 2, "qubo_clustering": 3, "clusterability": 2, "or_routing": 2, "qubo_routing": 2}
+
+def main():
+    # Usage: python run_benchmarks.py [manifest.json]
+    # Finished jobs are appended to the checkpoint of the manifest, running it again resumes the batch
+    manifest_file = sys.argv[1] if len(sys.argv)>1 else join(BENCHMARKS_DIR, 'manifest.json')
+    manifest, jobs = load_manifest(manifest_file)
+    data_dir = manifest.get("data_dir", "./data/")
+    checkpoint = manifest.get("checkpoint", "./results/benchmarks/checkpoint.jsonl")
+
+    with WorkerPool() as pool:
+        for record in run_batch(jobs, ALGORITHMS, pool, checkpoint, data_dir, COST_EXPONENTS):
+            if "error" in record:
+                print("{} {} {} failed after {:.2f}s\n{}".format(record["instance"], record["algorithm"], json.dumps(record["params"]),
+                                                                 record["time"], record["error"]))
+            else:
+                print("{} {} {} {:.2f}s {}".format(record["instance"], record["algorithm"], json.dumps(record["params"]),
+                                                   record["time"], json.dumps(record["result"])))
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,19 @@
 from hybrid.clustering.QUBO_Clustering import QUBO_Clustering
-from solver.Google_OR_Solver import solve_tsp
+from solver.Google_OR_Solver import solve_tsp, TimeBudget
 
-from helpers.utils import read_xml, plot_data, count_clusters_with_more_demand, compute_tsp_cluster_distances, calculate_total_distance
-from helpers.check_solution import check_solution
+from helpers.utils import read_xml, plot_data, count_clusters_with_more_demand, get_tsp_cluster_distances
+from helpers.RouteTotals import RouteTotals
+from helpers.WorkerPool import WorkerPool, load_instance
+from helpers.RenderWorker import RenderWorker
 
 from sklearn.metrics import silhouette_score
 
-import multiprocessing as mp
 
+# Seconds of OR-Tools search for all the clusters of an instance
+tsp_time_budget = 60
 
 def run_qubo_clustering(distances, vehicle_capacity, customer_demand, customer_locations, depot,
-                        save_file, num_reads, constraint_1_multiplier, constraint_2_multiplier):
+                        save_file, num_reads, constraint_1_multiplier, constraint_2_multiplier, renderer=None):
     
       
     # QUBO Clustering Algorithm
@@ -29,14 +32,14 @@ def run_qubo_clustering(distances, vehicle_capacity, customer_demand, customer_l
     print(f'Demand errors: {q_demand_errors}')
     
     plot_data(q_clusters, len(vehicle_capacity), vehicle_capacity[0], customer_locations, depot,
-        customer_demand, show_demand=False, show_cluster_demand=True, save_file=save_file)
+        customer_demand, show_demand=False, show_cluster_demand=True, save_file=save_file, renderer=renderer)
 
     
     return q_clusters
     
-def run_tsp_solver(cluster, customer_locations):
-    cluster_distances = compute_tsp_cluster_distances(customer_locations, cluster)
-    solution = solve_tsp(cluster_distances, 0)
+def run_tsp_solver(cluster, instance, time_budget=None):
+    cluster_distances = get_tsp_cluster_distances(load_instance(instance)["distances"], cluster)
+    solution = solve_tsp(cluster_distances, 0, time_budget=time_budget)
     parsed_solution = []
     for pair in solution[0]:
         if pair[0]==0:
@@ -53,21 +56,22 @@ def run_tsp_solver(cluster, customer_locations):
         
     return parsed_solution
 
-def run_classic_solvers(clusters, customer_locations):
-    # Run TSP OR-Tools solvers for each cluster
-    solutions = []
-    pool = mp.Pool(mp.cpu_count())
-    result_objects = [pool.apply_async(run_tsp_solver, args=(cluster, customer_locations[:-1])) for cluster in clusters]
-    for r in result_objects:
-        solutions += [r.get()]
-    pool.close()
-    pool.join()
+def run_classic_solvers(clusters, instance, pool, totals):
+    # Run TSP OR-Tools solvers for each cluster, all sharing one time budget
+    # Largest clusters first, every route is added to the totals as soon as it is solved
+    time_budget = TimeBudget(tsp_time_budget)
+    tasks = [(cluster, instance, time_budget) for cluster in clusters]
+    for k, solution in pool.as_completed(run_tsp_solver, tasks, sizes=[len(cluster) for cluster in clusters]):
+        totals.add(k, solution)
     
-    return solutions
+    return totals
     
 def main():
     # Do stuff
     problems = ['CMT01.xml','CMT02.xml','CMT03.xml','CMT04.xml','CMT05.xml']
+    # One pool for every problem of the run, figures are drawn in the background
+    renderer = RenderWorker()
+    pool = WorkerPool()
     for problem in problems:
         problem_name = problem.split(".xml")[0]
         customer_demand, vehicle_capacity, distances, customer_locations, depot = read_xml(
@@ -81,7 +85,7 @@ def main():
         
         save_file_qubo = "./results/hybrid_algorithm/"+problem_name+"_clustering.png"
         labels = run_qubo_clustering(distances, vehicle_capacity, customer_demand, customer_locations, depot,
-                                       save_file_qubo,  num_reads, constraint_1_multiplier, constraint_2_multiplier)
+                                       save_file_qubo,  num_reads, constraint_1_multiplier, constraint_2_multiplier, renderer)
         
         clusters = [[] for x in range(len(vehicle_capacity))]
         for i,x in enumerate(labels):
@@ -92,19 +96,24 @@ def main():
             './data/'+problem,0, True, True)
         
         # OR-Tools Routing
-        o_solutions = run_classic_solvers(clusters, customer_locations)
+        instance = pool.share_instance(problem, distances=distances)
+        o_totals = run_classic_solvers(clusters, instance, pool, RouteTotals(distances, customer_demand, vehicle_capacity))
+        pool.release_instance(problem)
         
+        o_solutions = o_totals.solution()
         if any(o_solutions):
-            o_total_distance = calculate_total_distance(o_solutions, distances)
-            o_errors = check_solution(o_solutions, 0, 0, customer_demand, vehicle_capacity, verbose = False)
+            o_total_distance = o_totals.total_distance
+            o_errors = o_totals.errors()
             save_file_or = "./results/hybrid_algorithm/"+problem_name+"_routing.png"
             
-            plot_data(labels, len(vehicle_capacity), vehicle_capacity[0], customer_locations, depot,
-              customer_demand, show_demand=False, show_cluster_demand=True, solution=o_solutions, save_file=save_file_or)
+            plot_data(labels, len(vehicle_capacity), vehicle_capacity[0], customer_locations[1:-1], depot,
+              customer_demand, show_demand=False, show_cluster_demand=True, solution=o_solutions, save_file=save_file_or, renderer=renderer)
             print("Total distance: ", o_total_distance)
             print("# Errors: ", o_errors)
         else:
             print("No solution found!")
+    pool.close()
+    renderer.close()
       
       
 if __name__ == "__main__":
@@ -1,20 +1,23 @@
 
 from ast import parse
-from solver.Google_OR_Solver import solve_cvrp, solve_tsp
+from solver.Google_OR_Solver import solve_cvrp, solve_tsp, TimeBudget
 import time
-from helpers.utils import read_xml, calculate_total_distance, get_files_in_folder, get_distances_wo_depots, compute_tsp_cluster_distances, plot_data, get_cluster_list
+from helpers.utils import read_xml, calculate_total_distance, get_files_in_folder, get_distances_wo_depots, get_tsp_cluster_distances, plot_data, get_cluster_list
 from helpers.check_solution import check_solution
+from helpers.WorkerPool import WorkerPool, load_instance
 import time
 
 import sys
 
 from hybrid.clustering.KMedoids import KMedoids
 
-import multiprocessing as mp
 
-def run_tsp_solver(cluster, customer_locations):
-    cluster_distances = compute_tsp_cluster_distances(customer_locations, cluster)
-    solution = solve_tsp(cluster_distances, 0)
+# Seconds of OR-Tools search for all the clusters of an instance
+tsp_time_budget = 60
+
+def run_tsp_solver(cluster, instance, time_budget=None):
+    cluster_distances = get_tsp_cluster_distances(load_instance(instance)["distances"], cluster)
+    solution = solve_tsp(cluster_distances, 0, time_budget=time_budget)
     parsed_solution = []
     #print(solution)
     #print(cluster)
@@ -55,6 +58,8 @@ def main():
     #                'X-n101-k25.xml',
     #                'VeRoLogV08_16.xml','VeRoLogV12_15.xml']:
     files = ['CMT01.xml']
+    # One pool for every problem of the run
+    pool = WorkerPool()
     for problem in files:
         # Read data
         if cluster:
@@ -81,15 +86,16 @@ def main():
             clusters = kmedoids.fit()
             #solutions = []
             #for cluster in clusters:
-            #    solution = run_tsp_solver(cluster, customer_locations[:-1])
+            #    solution = run_tsp_solver(cluster, get_tsp_cluster_distances(distances, cluster))
             #    solutions += [solution]
             solutions = []
-            pool = mp.Pool(mp.cpu_count())
-            result_objects = [pool.apply_async(run_tsp_solver, args=(cluster, customer_locations[:-1])) for cluster in clusters]
+            # All the clusters share one time budget
+            time_budget = TimeBudget(tsp_time_budget)
+            instance = pool.share_instance(problem, distances=distances)
+            result_objects = [pool.apply_async(run_tsp_solver, args=(cluster, instance, time_budget)) for cluster in clusters]
             for r in result_objects:
                 solutions += [r.get()]
-            pool.close()
-            pool.join()
+            pool.release_instance(problem)
         else:
             # Run VRPC solver
             solutions = solve_cvrp([0]+customer_demand, vehicle_capacity, distances, depot)
@@ -102,12 +108,13 @@ def main():
             errors = check_solution(solutions, 0, 0, customer_demand, vehicle_capacity, check_capacity=False, verbose = False)
             print("{},{},{},{:.2f},{},{:.2f}".format(problem,len(customer_demand), len(vehicle_capacity), 
                                                         end-start, errors, total_distance))
-            num_customers = max(max(clusters))+1
+            num_customers = len(customer_demand)
             plot_data(get_cluster_list(clusters, num_customers), len(vehicle_capacity), vehicle_capacity[0], customer_locations[1:-1], depot, 
                 customer_demand, solutions, show_demand=False, show_cluster_demand=False)
         else:
             print("{},{},{},{:.2f},No Solution".format(problem,len(customer_demand), len(vehicle_capacity), 
                                                             end-start))
+    pool.close()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,181 @@
+import numpy as np
+import time
+
+# Clusters up to HELD_KARP_MAX_NODES nodes (depot included) are solved with the bitmask dynamic
+# program, up to BRANCH_AND_BOUND_MAX_NODES with branch and bound, larger ones are left to OR-Tools
+HELD_KARP_MAX_NODES = 18
+BRANCH_AND_BOUND_MAX_NODES = 20
+BRANCH_AND_BOUND_TIME_LIMIT = 2
+
+def tour_to_solution(tour):
+    """
+    Converts a tour starting at node 0 into the list of arcs returned by solve_tsp
+    """
+    tour = list(tour) + [tour[0]]
+    return [list(zip(tour[:-1], tour[1:]))]
+
+def tour_length(tour, distances):
+    tour = list(tour)
+    return sum(distances[i][j] for i, j in zip(tour, tour[1:] + tour[:1]))
+
+def held_karp(distances):
+    """
+    Optimal tour from node 0 through all the nodes and back with the Held-Karp dynamic program
+    dp[S][k] is the shortest path from 0 through the customers in the bitmask S ending at k,
+    every subset size is solved for all the subsets at once
+    Returns the tour and its length
+    """
+    D = np.asarray(distances, dtype=float)
+    m = len(D)-1
+    if m <= 1:
+        return list(range(m+1)), tour_length(range(m+1), D)
+    customers = D[1:, 1:]
+    masks = np.arange(1 << m)
+    sizes = np.zeros(1 << m, dtype=int)
+    for k in range(m):
+        sizes += (masks >> k) & 1
+    dp = np.full((1 << m, m), np.inf)
+    parent = np.zeros((1 << m, m), dtype=np.int8)
+    dp[1 << np.arange(m), np.arange(m)] = D[0, 1:]
+    for size in range(2, m+1):
+        layer = masks[sizes == size]
+        for k in range(m):
+            subsets = layer[(layer >> k) & 1 == 1]
+            # Paths through the subset without k (dp is inf where k is the end) followed by j -> k
+            paths = dp[subsets ^ (1 << k)] + customers[:, k]
+            parent[subsets, k] = np.argmin(paths, axis=1)
+            dp[subsets, k] = paths[np.arange(len(subsets)), parent[subsets, k]]
+
+    full = (1 << m) - 1
+    lengths = dp[full] + D[1:, 0]
+    k = int(np.argmin(lengths))
+    tour = []
+    subset = full
+    for _ in range(m):
+        tour.append(k+1)
+        subset, k = subset ^ (1 << k), int(parent[subset, k])
+    return [0] + tour[::-1], lengths.min()
+
+def nearest_neighbour_tour(distances):
+    n = len(distances)
+    tour = [0]
+    unvisited = set(range(1, n))
+    while unvisited:
+        node = min(unvisited, key=lambda v: distances[tour[-1]][v])
+        tour.append(node)
+        unvisited.remove(node)
+    return tour
+
+def two_opt(tour, distances):
+    """
+    Reverses segments of the tour while that shortens it
+    """
+    tour = list(tour)
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n-1):
+            for j in range(i+1, n):
+                a, b, c, d = tour[i-1], tour[i], tour[j], tour[(j+1) % n]
+                before = distances[a][b] + distances[c][d] + tour_length(tour[i:j+1], distances) - distances[c][b]
+                after = distances[a][c] + distances[b][d] + tour_length(tour[i:j+1][::-1], distances) - distances[b][c]
+                if after < before - 1e-12:
+                    tour[i:j+1] = tour[i:j+1][::-1]
+                    improved = True
+    return tour
+
+def spanning_tree_length(nodes, distances):
+    """
+    Length of the minimum spanning tree of nodes (Prim)
+    """
+    if len(nodes) < 2:
+        return 0
+    cost = {v: distances[nodes[0]][v] for v in nodes[1:]}
+    total = 0
+    while cost:
+        v = min(cost, key=cost.get)
+        total += cost.pop(v)
+        for u in cost:
+            if distances[v][u] < cost[u]:
+                cost[u] = distances[v][u]
+    return total
+
+def branch_and_bound(distances, time_limit=BRANCH_AND_BOUND_TIME_LIMIT):
+    """
+    Depth first branch and bound over the tours starting at node 0, closest nodes first
+    The rest of a tour is a path from the last node through the unvisited nodes back to 0, so it
+    is at least as long as their minimum spanning tree (on the shorter direction of every arc)
+    Returns the best tour, its length and whether it is proven optimal (the search ended in time)
+    """
+    D = np.asarray(distances, dtype=float)
+    n = len(D)
+    neighbours = np.argsort(D + np.diag(np.full(n, np.inf)), axis=1)[:, :n-1].tolist()
+    symmetric = np.minimum(D, D.T).tolist()
+    D = D.tolist()
+
+    best_tour = two_opt(nearest_neighbour_tour(D), D)
+    best = [tour_length(best_tour, D), best_tour]
+    deadline = None if time_limit is None else time.time() + time_limit
+    expanded = [0]
+
+    def search(path, unvisited, length):
+        node = path[-1]
+        if not unvisited:
+            length += D[node][0]
+            if length < best[0]:
+                best[0], best[1] = length, list(path)
+            return True
+        expanded[0] += 1
+        if deadline is not None and expanded[0] % 256 == 0 and time.time() > deadline:
+            return False
+        for v in neighbours[node]:
+            if v not in unvisited:
+                continue
+            next_length = length + D[node][v]
+            unvisited.remove(v)
+            bound = next_length + spanning_tree_length([v, 0] + list(unvisited), symmetric)
+            finished = True
+            if bound < best[0]:
+                path.append(v)
+                finished = search(path, unvisited, next_length)
+                path.pop()
+            unvisited.add(v)
+            if not finished:
+                return False
+        return True
+
+    proven = search([0], set(range(1, n)), 0)
+    return best[1], best[0], proven
+
+def exact_tsp_tour(distances, depot=0, time_limit=BRANCH_AND_BOUND_TIME_LIMIT):
+    """
+    Best tour of a small problem starting at depot, chosen by size: Held-Karp up to
+    HELD_KARP_MAX_NODES nodes and branch and bound up to BRANCH_AND_BOUND_MAX_NODES
+    Returns the tour and whether it is proven optimal (branch and bound may run out of
+    time_limit), or None when the problem is too large
+    """
+    n = len(distances)
+    if n > BRANCH_AND_BOUND_MAX_NODES:
+        return None
+    D = np.asarray(distances, dtype=float)
+    # Solve with the depot as node 0
+    order = np.r_[depot, np.delete(np.arange(n), depot)]
+    D = D[np.ix_(order, order)]
+    if n <= HELD_KARP_MAX_NODES:
+        tour, _ = held_karp(D)
+        proven = True
+    else:
+        tour, _, proven = branch_and_bound(D, time_limit)
+    return order[tour].tolist(), proven
+
+def solve_exact_tsp(distances, depot=0, time_limit=BRANCH_AND_BOUND_TIME_LIMIT):
+    """
+    Optimal TSP tour for small problems, see exact_tsp_tour
+    Returns the arcs in the format of solve_tsp, or None when the problem is too large or the
+    branch and bound could not prove its tour optimal within time_limit
+    """
+    result = exact_tsp_tour(distances, depot, time_limit)
+    if result is None or not result[1]:
+        return None
+    return tour_to_solution(result[0])
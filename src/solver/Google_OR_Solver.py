@@ -1,14 +1,81 @@
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
+import numpy as np
+import time
 
-def create_data_model(distances, depot, vehicle_capacity=None, customer_demand=None):
+from solver.Exact_TSP_Solver import exact_tsp_tour, tour_to_solution, BRANCH_AND_BOUND_TIME_LIMIT
+from helpers.DistanceMatrix import DistanceMatrix
+
+# OR-Tools only works with integer arc costs, distances are multiplied by this before rounding
+DISTANCE_PRECISION = 1000
+
+# Time policy: every call gets TIME_PER_NODE seconds per node within [MIN_TIME_LIMIT, MAX_TIME_LIMIT]
+# and stops earlier when the cost has not improved for STALL_TIME_LIMIT seconds
+TIME_PER_NODE = 0.1
+MIN_TIME_LIMIT = 1
+MAX_TIME_LIMIT = 30
+STALL_TIME_LIMIT = 3
+
+class TimeBudget:
+    """Time shared by all the solver calls of an instance.
+    The deadline is a wall clock time, so the budget can be sent to worker processes."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.time() + seconds
+
+    def remaining(self):
+        return max(self.deadline - time.time(), 0)
+
+def size_time_limit(num_nodes):
+    """Seconds of search for a problem with num_nodes nodes."""
+    return min(max(num_nodes*TIME_PER_NODE, MIN_TIME_LIMIT), MAX_TIME_LIMIT)
+
+def set_search_limits(search_parameters, num_nodes, time_limit=None, solution_limit=None, time_budget=None):
+    """Sets the time and solution limits of a call, within what is left of time_budget.
+    Once the budget is spent only the first solution is built."""
+    if time_limit is None:
+        time_limit = size_time_limit(num_nodes)
+    if time_budget is not None:
+        remaining = time_budget.remaining()
+        if remaining > 0:
+            time_limit = min(time_limit, remaining)
+        else:
+            solution_limit = 1
+    search_parameters.time_limit.FromMilliseconds(int(time_limit*1000))
+    if solution_limit is not None:
+        search_parameters.solution_limit = solution_limit
+
+def add_stall_limit(routing, stall_time):
+    """Stops the search when the cost has not improved for stall_time seconds.
+    Returns the callback, which must be kept alive until the search ends."""
+    state = {'best': None, 'time': time.time()}
+    def stall_callback():
+        cost = routing.CostVar().Max()
+        now = time.time()
+        if state['best'] is None or cost < state['best']:
+            state['best'] = cost
+            state['time'] = now
+        elif now - state['time'] > stall_time:
+            routing.solver().FinishCurrentSearch()
+    routing.AddAtSolutionCallback(stall_callback)
+    return stall_callback
+
+def scale_distances(distances, precision=DISTANCE_PRECISION):
+    """Rounds distances*precision to the integer matrix registered in OR-Tools.
+    OR-Tools reads the arc costs from Python lists, a DistanceMatrix is converted one row at a
+    time so no dense float copy of it is built."""
+    if isinstance(distances, DistanceMatrix):
+        return [np.rint(distances[i]*precision).astype(np.int64).tolist() for i in range(len(distances))]
+    return np.rint(np.asarray(distances, dtype=float)*precision).astype(np.int64).tolist()
+
+def create_data_model(distances, depot, vehicle_capacity=None, customer_demand=None, precision=DISTANCE_PRECISION):
     """Stores the data for the problem."""
     data = {}
-    data['distance_matrix'] = distances
+    data['distance_matrix'] = scale_distances(distances, precision)
     data['depot'] = depot
-    if customer_demand != None:
-        data['demands'] = customer_demand
-    if vehicle_capacity != None:
+    if customer_demand is not None:
+        data['demands'] = [int(d) for d in customer_demand]
+    if vehicle_capacity is not None:
         data['vehicle_capacities'] = vehicle_capacity
         data['num_vehicles'] = len(vehicle_capacity)
     else:
@@ -58,10 +125,16 @@ def parse_solution(data, manager, routing, solution):
         solutions += [sol]
     return solutions
 
-def solve_cvrp(customer_demand, vehicle_capacity, distances, depot):
-    """Solve the CVRP problem."""
+def solve_cvrp(customer_demand, vehicle_capacity, distances, depot, precision=DISTANCE_PRECISION,
+               time_limit=None, stall_time=STALL_TIME_LIMIT, solution_limit=None, time_budget=None,
+               return_time=False):
+    """Solve the CVRP problem.
+    Distances are multiplied by precision and rounded to integers for OR-Tools.
+    time_limit defaults to size_time_limit, time_budget is a TimeBudget shared with other calls.
+    return_time also returns the seconds the call took."""
+    start = time.time()
     # Instantiate the data problem.
-    data = create_data_model(distances, depot, vehicle_capacity, customer_demand)
+    data = create_data_model(distances, depot, vehicle_capacity, customer_demand, precision)
 
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(len(data['distance_matrix']),
@@ -71,29 +144,15 @@ def solve_cvrp(customer_demand, vehicle_capacity, distances, depot):
     routing = pywrapcp.RoutingModel(manager)
 
 
-    # Create and register a transit callback.
-    def distance_callback(from_index, to_index):
-        """Returns the distance between the two nodes."""
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['distance_matrix'][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # Register the distance matrix, arcs are evaluated without calling back into Python.
+    transit_callback_index = routing.RegisterTransitMatrix(data['distance_matrix'])
 
     # Define cost of each arc.
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
 
     # Add Capacity constraint.
-    def demand_callback(from_index):
-        """Returns the demand of the node."""
-        # Convert from routing variable Index to demands NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        return data['demands'][from_node]
-
-    demand_callback_index = routing.RegisterUnaryTransitCallback(
-        demand_callback)
+    demand_callback_index = routing.RegisterUnaryTransitVector(data['demands'])
     routing.AddDimensionWithVehicleCapacity(
         demand_callback_index,
         0,  # null capacity slack
@@ -107,17 +166,21 @@ def solve_cvrp(customer_demand, vehicle_capacity, distances, depot):
         routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
     search_parameters.local_search_metaheuristic = (
         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.FromSeconds(1)
+    set_search_limits(search_parameters, len(data['distance_matrix']), time_limit, solution_limit, time_budget)
+    if stall_time is not None:
+        stall_callback = add_stall_limit(routing, stall_time)
 
     # Solve the problem.
     solution = routing.SolveWithParameters(search_parameters)
 
     # Print solution on console.
+    solutions = None
     if solution:
         #print_solution(data, manager, routing, solution)
         solutions = parse_solution(data, manager, routing, solution)
-        return solutions
-    return None
+    if return_time:
+        return solutions, time.time()-start
+    return solutions
 
 def print_solution_tsp(manager, routing, solution):
     """Prints solution on console."""
@@ -136,10 +199,31 @@ def print_solution_tsp(manager, routing, solution):
     
 
 
-def solve_tsp(distances, depot):
-
+def solve_tsp(distances, depot, precision=DISTANCE_PRECISION, time_limit=None, stall_time=STALL_TIME_LIMIT,
+              solution_limit=None, time_budget=None, return_time=False, exact=True):
+    """Solve the TSP problem.
+    exact: small problems are solved optimally by exact_tsp_tour, the rest with OR-Tools. Its branch
+    and bound stops within time_limit and time_budget, a tour it could not prove optimal is the
+    first solution of OR-Tools.
+    Distances are multiplied by precision and rounded to integers for OR-Tools.
+    time_limit defaults to size_time_limit, time_budget is a TimeBudget shared with other calls.
+    return_time also returns the seconds the call took."""
+    start = time.time()
+    initial_tour = None
+    if exact:
+        exact_time_limit = BRANCH_AND_BOUND_TIME_LIMIT
+        if time_limit is not None:
+            exact_time_limit = min(exact_time_limit, time_limit)
+        if time_budget is not None:
+            exact_time_limit = min(exact_time_limit, time_budget.remaining())
+        result = exact_tsp_tour(distances, depot, exact_time_limit)
+        if result is not None:
+            initial_tour, proven = result
+            if proven:
+                solutions = tour_to_solution(initial_tour)
+                return (solutions, time.time()-start) if return_time else solutions
     #Instantiate the data problem
-    data = create_data_model(distances, depot)
+    data = create_data_model(distances, depot, precision=precision)
     
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(len(data['distance_matrix']),
@@ -148,15 +232,8 @@ def solve_tsp(distances, depot):
     # Create Routing Model.
     routing = pywrapcp.RoutingModel(manager)
     
-    def distance_callback(from_index, to_index):
-        """Returns the distance between the two nodes."""
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['distance_matrix'][from_node][to_node]
-
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # Register the distance matrix, arcs are evaluated without calling back into Python.
+    transit_callback_index = routing.RegisterTransitMatrix(data['distance_matrix'])
 
     # Define cost of each arc.
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
@@ -165,15 +242,25 @@ def solve_tsp(distances, depot):
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
     search_parameters.local_search_metaheuristic = (
         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.seconds = 30
+    set_search_limits(search_parameters, len(data['distance_matrix']), time_limit, solution_limit, time_budget)
     search_parameters.log_search = False
+    if stall_time is not None:
+        stall_callback = add_stall_limit(routing, stall_time)
 
-    # Solve the problem.
-    solution = routing.SolveWithParameters(search_parameters)
+    # Solve the problem, from the tour of the branch and bound when it has one.
+    if initial_tour is not None:
+        routing.CloseModelWithParameters(search_parameters)
+        route = [manager.NodeToIndex(node) for node in initial_tour[1:]]
+        initial_solution = routing.ReadAssignmentFromRoutes([route], True)
+        solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
+    else:
+        solution = routing.SolveWithParameters(search_parameters)
 
     # Print solution on console.
+    solutions = None
     if solution:
         #print_solution(manager, routing, solution)
         solutions = parse_solution(data, manager, routing, solution)
-        return solutions
-    return None
\ No newline at end of file
+    if return_time:
+        return solutions, time.time()-start
+    return solutions
\ No newline at end of file
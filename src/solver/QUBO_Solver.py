@@ -1,22 +1,34 @@
 from pyqubo import Array, Constraint, Placeholder, solve_qubo
 import numpy as np
 import neal
+import math
 
 from dwave.system import DWaveSampler, EmbeddingComposite
 
-from helpers.utils import powerset
+from helpers.utils import powerset, decode_vrp_samples, vrp_sample_routes
+from helpers.check_solution import check_solutions
+from helpers.qubo_utils import binary_coefficients, pair_count, qubo_size, check_memory_budget
 
 class QUBO_Solver:
   def __init__(self, distances, vehicle_capacity, customer_demand,
                cost_multiplier, constraint_1_multiplier, constraint_2_multiplier, 
                constraint_3_multiplier, constraint_4_multiplier,
-               constraint_5_multiplier, constraint_6_multiplier,):
+               constraint_5_multiplier, constraint_6_multiplier, subtour_elimination="powerset",
+               memory_budget=None):
+    """
+    subtour_elimination: "powerset" adds one constraint for every subset of customers (2^n),
+    "mtz" uses Miller-Tucker-Zemlin positions, which only needs O(n^2 log n) variables
+    memory_budget: bytes the QUBO may take, a powerset QUBO over the budget falls back to "mtz"
+    """
+    if subtour_elimination not in ("powerset", "mtz"):
+      raise ValueError("Unknown subtour elimination {}".format(subtour_elimination))
     self.num_customers = len(customer_demand)
     self.num_vehicles = len(vehicle_capacity)
     self.distances = distances
     self.vehicle_capacity = vehicle_capacity
     self.customer_demand = customer_demand
-    self.powerset = [x for x in powerset([i for i in range(1,self.num_customers+1)]) if len(x)>=2]
+    self.subtour_elimination = subtour_elimination
+    self.powerset = None
     self.all_vertices = self.num_customers + 2
     self.cost_multiplier = cost_multiplier
     self.constraint_1_multiplier = constraint_1_multiplier
@@ -25,15 +37,31 @@ class QUBO_Solver:
     self.constraint_4_multiplier = constraint_4_multiplier
     self.constraint_5_multiplier = constraint_5_multiplier
     self.constraint_6_multiplier = constraint_6_multiplier
+    self.memory_budget = memory_budget
+    if memory_budget is not None and subtour_elimination == "powerset" and \
+      self.estimate_qubo_size().memory > memory_budget:
+      self.subtour_elimination = "mtz"
+    
+  def get_powerset(self):
+    """
+    Returns the subsets of customers for the powerset subtour elimination, built on first use
+    """
+    if self.powerset is None:
+      self.powerset = []
+      if self.subtour_elimination == "powerset":
+        self.powerset = [x for x in powerset([i for i in range(1,self.num_customers+1)]) if len(x)>=2]
+    return self.powerset
 
   def build_qubo(self):
-    
+    check_memory_budget(self.estimate_qubo_size(), self.memory_budget)
+    powerset = self.get_powerset()
 
     x = Array.create("x", shape=(self.all_vertices, self.all_vertices, self.num_vehicles), vartype="BINARY")
     # Create slack variables
     capacity_slack = Array.create("capacity_slack", shape=(self.num_vehicles, self.vehicle_capacity[0]-1), vartype="BINARY")
     # subtour elimination
-    powerset_slack = Array.create("powerset_slack", shape=(len(self.powerset), max(len(s) for s in self.powerset)), vartype="BINARY")
+    if self.subtour_elimination == "powerset":
+      powerset_slack = Array.create("powerset_slack", shape=(len(powerset), max(len(s) for s in powerset)), vartype="BINARY")
     
     # Main Equation
 
@@ -91,7 +119,7 @@ class QUBO_Solver:
     # A vehicle can only carry up to its capacity
     ct5 = 0
     for k in range(self.num_vehicles):
-        ct5_t = -self.vehicle_capacity
+        ct5_t = -self.vehicle_capacity[k]
         for i in range(1, self.num_customers+1):
             for j in range(1, self.num_customers+1):
                 if(i!=j):
@@ -102,41 +130,106 @@ class QUBO_Solver:
         ct5 += Constraint(ct5_t, label="Vehicle {} must not exceed carrying capacity {}".format(k, self.vehicle_capacity[0]))
 
     # Closed loop subtour elimination
-    ct6 = 0
-    for e,s in enumerate(powerset):
-        ct6_t = -(len(powerset)-1)
-        for k in range(self.num_vehicles):
-            for i in range(len(s)):
-                for j in range(i+1,len(s)):
-                    ct6_t += 1 * x[i][j][k]
-        for l,v  in enumerate(s):
-          ct6_t += (l+1)*powerset_slack[e][v]
-        ct6_t = ct6_t**2
-        ct6 += Constraint(ct6_t, label="Subtour found")
+    if self.subtour_elimination == "mtz":
+      ct6 = self.build_mtz_constraint(x)
+    else:
+      ct6 = 0
+      for e,s in enumerate(powerset):
+          ct6_t = -(len(powerset)-1)
+          for k in range(self.num_vehicles):
+              for i in range(len(s)):
+                  for j in range(i+1,len(s)):
+                      ct6_t += 1 * x[i][j][k]
+          for l,v  in enumerate(s):
+            ct6_t += (l+1)*powerset_slack[e][l]
+          ct6_t = ct6_t**2
+          ct6 += Constraint(ct6_t, label="Subtour found")
         
     final_eq = eq + ct1*self.constraint_1_multiplier + ct2*self.constraint_2_multiplier + \
       ct3*self.constraint_3_multiplier + ct4*self.constraint_4_multiplier + ct5*self.constraint_5_multiplier + ct6*self.constraint_6_multiplier
 
     return final_eq
-      
-  def get_solution(self, num_reads=10000, verbose=False):
+
+  def estimate_qubo_size(self):
+    """
+    Predicts the size of the QUBO without building it
+    The quadratic terms are an upper bound, the sum of the terms of every squared constraint
+    """
+    n, K, V = self.num_customers, self.num_vehicles, self.all_vertices
+    num_variables = V*V*K + K*(self.vehicle_capacity[0]-1)
+    quadratic_terms = n*pair_count(K*(V-1)) + 2*K*pair_count(V) + n*K*pair_count(2*(V-1)) + \
+      K*pair_count(n*(n-1) + self.vehicle_capacity[0]-1)
+    if self.subtour_elimination == "mtz":
+      num_positions = len(binary_coefficients(n-1))
+      num_slack = len(binary_coefficients(2*n-2))
+      num_variables += n*num_positions + n*(n-1)*num_slack
+      quadratic_terms += n*(n-1)*pair_count(2*num_positions + K + num_slack)
+    else:
+      for m in range(2, n+1):
+        num_variables += math.comb(n, m)*m
+        quadratic_terms += math.comb(n, m)*pair_count(K*pair_count(m) + m)
+    return qubo_size(num_variables, quadratic_terms, "pyqubo")
+  
+  def build_mtz_constraint(self, x):
+    """
+    Miller-Tucker-Zemlin subtour elimination: every customer i gets a position u_i in 0..n-1
+    and u_i - u_j + n*sum_k x[i][j][k] <= n-1 must hold for every pair of customers
+    The positions and the slack of every inequality are binary encoded
+    """
+    n = self.num_customers
+    position_coefficients = binary_coefficients(n-1)
+    slack_coefficients = binary_coefficients(2*n-2)
+    position = Array.create("position", shape=(n, len(position_coefficients)), vartype="BINARY")
+    mtz_slack = Array.create("mtz_slack", shape=(n, n, len(slack_coefficients)), vartype="BINARY")
     
-        qubo, model = self.build_qubo_model()
+    ct6 = 0
+    for i in range(1, n+1):
+        for j in range(1, n+1):
+            if (i!=j):
+                ct6_t = -(n-1)
+                for b, c in enumerate(position_coefficients):
+                    ct6_t += c*position[i-1][b] - c*position[j-1][b]
+                for k in range(self.num_vehicles):
+                    ct6_t += n*x[i][j][k]
+                for l, c in enumerate(slack_coefficients):
+                    ct6_t += c*mtz_slack[i-1][j-1][l]
+                ct6_t = ct6_t**2
+                ct6 += Constraint(ct6_t, label="Subtour found between {} and {}".format(i, j))
+    return ct6
+      
+  def get_solution(self, num_reads=10000, verbose=False, all_reads=True):
+        """
+        Samples the compiled QUBO and decodes the arcs x[i][j][k] of the reads into routes
+        all_reads: every distinct read is decoded and the one with the fewest broken constraints
+        (then the shortest one) is returned, otherwise the lowest energy read
+        Returns the energy and the routes of every vehicle, like QUBO_Solver_DADK
+        """
+        model = self.build_qubo().compile()
+        bqm = model.to_bqm()
         sampler = neal.SimulatedAnnealingSampler()
-        sa_solution = sampler.sample_qubo(qubo, num_reads=num_reads)
-        raw_solution = sa_solution.first.sample
-        energy = sa_solution.first.energy
-        # decode for easier analysis
-        decoded_samples = model.decode_sample(raw_solution, vartype="BINARY")
+        sampleset = sampler.sample(bqm, num_reads=num_reads).aggregate()
+        
+        # Arc variables in x[i][j][k] order, arcs PyQUBO dropped (no terms) are never used
+        V, K = self.all_vertices, self.num_vehicles
+        arc_index = {"x[{}][{}][{}]".format(i, j, k): (i*V + j)*K + k for i in range(V) for j in range(V) for k in range(K)}
+        samples = np.zeros((len(sampleset), V*V*K), dtype=np.int8)
+        for column, variable in enumerate(sampleset.variables):
+            if variable in arc_index:
+                samples[:, arc_index[variable]] = sampleset.record.sample[:, column]
+        energies = sampleset.record.energy
+        x = decode_vrp_samples(samples, self.num_customers, self.num_vehicles)
+        solutions = [vrp_sample_routes(sample) for sample in x]
+        if all_reads:
+            errors = sum(check_solutions(solutions, 0, self.num_customers+1, self.customer_demand,
+                                         self.vehicle_capacity).values())
+            distances = np.einsum("rijk,ij->r", x, np.asarray(self.distances, dtype=float))
+            best = np.lexsort((energies, distances, errors))[0]
+        else:
+            best = int(np.argmin(energies))
+        
         if verbose:
-          print("Energy:",energy)
+          print("Energy:", energies[best])
           # Show failed constraints
-          print(decoded_samples.constraints(only_broken=True))
-        # extract label
-        customer_clusters = [-1]*self.num_customers
-        for k in range(self.num_clusters):
-            for i in range(self.num_customers):
-                if decoded_samples.array("x", (i,k)) == 1:
-                    customer_clusters[i] = k
-                #print("Cluster",k,", customer",i,"=",decoded_samples.array("x", (i,k)))
-        return customer_clusters
\ No newline at end of file
+          decoded_sample = model.decode_sample(dict(zip(sampleset.variables, sampleset.record.sample[best].tolist())), vartype="BINARY")
+          print(decoded_sample.constraints(only_broken=True))
+        return energies[best], solutions[best]
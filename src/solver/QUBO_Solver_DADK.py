@@ -1,22 +1,35 @@
 import neal
+import math
+import numpy as np
 
 from dwave.system import DWaveSampler, EmbeddingComposite
 
 from dadk.BinPol import BitArrayShape, VarSlack, VarShapeSet, SlackType, BinPol
 
-from helpers.utils import powerset
+from helpers.utils import powerset, sample_to_array, decode_vrp_samples, vrp_sample_routes
+from helpers.check_solution import check_solutions
+from helpers.qubo_utils import sampleset_to_array, binary_coefficients, pair_count, qubo_size, check_memory_budget
 
 class QUBO_Solver_DADK:
   def __init__(self, distances, vehicle_capacity, customer_demand,
                cost_multiplier, constraint_1_multiplier, constraint_2_multiplier, 
                constraint_3_multiplier, constraint_4_multiplier,
-               constraint_5_multiplier, constraint_6_multiplier):
+               constraint_5_multiplier, constraint_6_multiplier, subtour_elimination="powerset",
+               memory_budget=None):
+    """
+    subtour_elimination: "powerset" adds one constraint for every subset of customers (2^n),
+    "mtz" uses Miller-Tucker-Zemlin positions, which only needs O(n^2 log n) variables
+    memory_budget: bytes the QUBO may take, a powerset QUBO over the budget falls back to "mtz"
+    """
+    if subtour_elimination not in ("powerset", "mtz"):
+      raise ValueError("Unknown subtour elimination {}".format(subtour_elimination))
     self.num_customers = len(customer_demand)
     self.num_vehicles = len(vehicle_capacity)
     self.distances = distances
     self.vehicle_capacity = vehicle_capacity
     self.customer_demand = customer_demand
-    self.powerset = [x for x in powerset([i for i in range(1,self.num_customers+1)]) if len(x)>=2]
+    self.subtour_elimination = subtour_elimination
+    self.powerset = None
     self.all_vertices = self.num_customers + 2
     self.cost_multiplier = cost_multiplier
     self.constraint_1_multiplier = constraint_1_multiplier
@@ -25,11 +38,26 @@ class QUBO_Solver_DADK:
     self.constraint_4_multiplier = constraint_4_multiplier
     self.constraint_5_multiplier = constraint_5_multiplier
     self.constraint_6_multiplier = constraint_6_multiplier
+    self.memory_budget = memory_budget
+    if memory_budget is not None and subtour_elimination == "powerset" and \
+      self.estimate_qubo_size().memory > memory_budget:
+      self.subtour_elimination = "mtz"
+    
+  def get_powerset(self):
+    """
+    Returns the subsets of customers for the powerset subtour elimination, built on first use
+    """
+    if self.powerset is None:
+      self.powerset = []
+      if self.subtour_elimination == "powerset":
+        self.powerset = [x for x in powerset([i for i in range(1,self.num_customers+1)]) if len(x)>=2]
+    return self.powerset
     
   def qubo_len(self):
-      vars_powerset = 0
-      for s in self.powerset:
-          vars_powerset += len(s)-1
+      n = self.num_customers
+      vars_powerset = sum(math.comb(n, m)*(m-1) for m in range(2, n+1))
+      if self.subtour_elimination == "mtz":
+          vars_powerset = n*len(binary_coefficients(n-1)) + n*(n-1)*len(binary_coefficients(2*n-2))
           
       vars_capacity = 0
       for i in range(self.num_vehicles):
@@ -41,6 +69,8 @@ class QUBO_Solver_DADK:
       return (self.all_vertices * self.all_vertices * self.num_vehicles) + vars_capacity + vars_powerset
 
   def build_qubo(self):
+    check_memory_budget(self.estimate_qubo_size(), self.memory_budget)
+    powerset = self.get_powerset()
     
     # Create the set of variables
     my_bit_shape_array = BitArrayShape(name='vrp_arr', shape=(self.all_vertices, self.all_vertices, self.num_vehicles), 
@@ -48,15 +78,27 @@ class QUBO_Solver_DADK:
     # Create slack variables
     slack_list = []
     # subtour elimination
-    for i, s in enumerate(self.powerset):
+    for i, s in enumerate(powerset):
         slack_list.append(VarSlack(name='slack_variable_c_6_'+str(i),start=0,step=1,
                                stop=len(s)-1, slack_type=SlackType.binary))
+    if self.subtour_elimination == "mtz":
+        for i in range(1, self.num_customers+1):
+            for j in range(1, self.num_customers+1):
+                if (i!=j):
+                    slack_list.append(VarSlack(name='slack_variable_c_6_{}_{}'.format(i, j),start=0,step=1,
+                                           stop=2*self.num_customers-2, slack_type=SlackType.binary))
     # vehicle capacity
     for i in range(self.num_vehicles):
         slack_list.append(VarSlack(name='slack_variable_c_5_'+str(i),start=0,step=1,
                                 stop=self.vehicle_capacity[i], slack_type=SlackType.binary))
     
-    my_varshapeset = VarShapeSet(my_bit_shape_array, *slack_list)
+    shapes = [my_bit_shape_array]
+    if self.subtour_elimination == "mtz":
+        # Binary encoded position of every customer in its route
+        shapes.append(BitArrayShape(name='position', shape=(self.num_customers, len(binary_coefficients(self.num_customers-1))),
+                                    axis_names=['customer', 'bit']))
+    
+    my_varshapeset = VarShapeSet(*shapes, *slack_list)
     
     
     # Main Equation
@@ -127,14 +169,17 @@ class QUBO_Solver_DADK:
         ct5 += ((ct5_t-self.vehicle_capacity[k]).add_slack_variable('slack_variable_c_5_'+str(k),factor=1))**2
 
     # Closed loop subtour elimination
-    ct6 = BinPol(my_varshapeset)
-    for e,s in enumerate(self.powerset):
+    if self.subtour_elimination == "mtz":
+        ct6 = self.build_mtz_constraint(my_varshapeset)
+    else:
+        ct6 = BinPol(my_varshapeset)
+    for e,s in enumerate(powerset):
         ct6_t = BinPol(my_varshapeset)
         for k in range(self.num_vehicles):
             for i in range(len(s)):
                 for j in range(i+1,len(s)):
                     ct6_t.add_term(1, ("vrp_arr",i,j,k))
-        ct6 += ((ct6_t-(len(self.powerset)-1)).add_slack_variable('slack_variable_c_6_'+str(e),factor=1))**2
+        ct6 += ((ct6_t-(len(powerset)-1)).add_slack_variable('slack_variable_c_6_'+str(e),factor=1))**2
         
         
     final_eq = BinPol.sum(eq + ct1*self.constraint_1_multiplier,
@@ -146,27 +191,75 @@ class QUBO_Solver_DADK:
                          )
 
     return final_eq
+
+  def estimate_qubo_size(self):
+    """
+    Predicts the size of the QUBO without building it
+    The quadratic terms are an upper bound, the sum of the terms of every squared constraint
+    """
+    n, K, V = self.num_customers, self.num_vehicles, self.all_vertices
+    capacity_slack = [len(binary_coefficients(c)) for c in self.vehicle_capacity]
+    num_variables = V*V*K + sum(capacity_slack)
+    quadratic_terms = n*pair_count(K*(V-1)) + 2*K*pair_count(V) + n*K*pair_count(2*(V-1)) + \
+      sum(pair_count(n*(n-1) + s) for s in capacity_slack)
+    if self.subtour_elimination == "mtz":
+      num_positions = len(binary_coefficients(n-1))
+      num_slack = len(binary_coefficients(2*n-2))
+      num_variables += n*num_positions + n*(n-1)*num_slack
+      quadratic_terms += n*(n-1)*pair_count(2*num_positions + K + num_slack)
+    else:
+      for m in range(2, n+1):
+        num_slack = len(binary_coefficients(m-1))
+        num_variables += math.comb(n, m)*num_slack
+        quadratic_terms += math.comb(n, m)*pair_count(K*pair_count(m) + num_slack)
+    return qubo_size(num_variables, quadratic_terms, "dadk")
+  
+  def build_mtz_constraint(self, my_varshapeset):
+    """
+    Miller-Tucker-Zemlin subtour elimination: every customer i gets a position u_i in 0..n-1
+    and u_i - u_j + n*sum_k x[i][j][k] <= n-1 must hold for every pair of customers
+    """
+    n = self.num_customers
+    position_coefficients = binary_coefficients(n-1)
+    ct6 = BinPol(my_varshapeset)
+    for i in range(1, n+1):
+        for j in range(1, n+1):
+            if (i!=j):
+                ct6_t = BinPol(my_varshapeset)
+                for b, c in enumerate(position_coefficients):
+                    ct6_t.add_term(c, ("position",i-1,b))
+                    ct6_t.add_term(-c, ("position",j-1,b))
+                for k in range(self.num_vehicles):
+                    ct6_t.add_term(n, ("vrp_arr",i,j,k))
+                ct6 += ((ct6_t-(n-1)).add_slack_variable('slack_variable_c_6_{}_{}'.format(i, j),factor=1))**2
+    return ct6
   
   def get_bqm(self):
         return self.build_qubo().as_bqm()
       
-  def get_solution(self, num_reads=10000):
+  def get_solution(self, num_reads=10000, all_reads=True):
+        """
+        all_reads: every distinct read is decoded and the one with the fewest broken constraints
+        (then the shortest one) is returned, otherwise the lowest energy read
+        """
         bqm = self.get_bqm()
     
         sa = neal.SimulatedAnnealingSampler()
         
         sampleset = sa.sample(bqm, num_reads=num_reads)
-        solution = sampleset.aggregate().first
+        if not all_reads:
+          solution = sampleset.aggregate().first
+          bits = sample_to_array(solution.sample.values())
+          x = decode_vrp_samples(bits[None, :], self.num_customers, self.num_vehicles)[0]
+          return solution.energy, vrp_sample_routes(x)
         
-        solution_processed = [[] for _ in range(self.num_vehicles)]
-        tuples = []
-        for i in range(self.num_customers+2):
-            for j in range(self.num_customers+2):
-                for k in range(self.num_vehicles):
-                    tuples += [(i,j,k)]
-
-        for i, val in enumerate(solution.sample.values()):
-            if val==1 and i < len(tuples):
-                solution_processed[tuples[i][2]] += [(tuples[i][0],tuples[i][1])]
+        sampleset = sampleset.aggregate()
+        samples, energies = sampleset_to_array(sampleset, len(sampleset.variables))
+        x = decode_vrp_samples(samples, self.num_customers, self.num_vehicles)
+        solutions = [vrp_sample_routes(sample) for sample in x]
+        errors = sum(check_solutions(solutions, 0, self.num_customers+1, self.customer_demand,
+                                     self.vehicle_capacity).values())
+        distances = np.einsum("rijk,ij->r", x, np.asarray(self.distances, dtype=float))
+        best = np.lexsort((energies, distances, errors))[0]
         
-        return solution.energy, solution_processed
\ No newline at end of file
+        return energies[best], solutions[best]